@@ -1,19 +1,214 @@
 # datacampus_agent_metodos_adicionales.py
 # Métodos adicionales que podrían faltarte en DatacampusAgent
 
+import base64
+import email.utils
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
-from typing import Dict, Any, Optional, BinaryIO
+import mimetypes
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, BinaryIO, List, Tuple
+from urllib.parse import quote
 import json
 
+from config import EXCEL_READ_ENGINE
+from core.json_graph import json_dumps, json_loads
+
+
 logger = logging.getLogger(__name__)
 
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+# Límite de sub-peticiones por llamada a /$batch impuesto por Microsoft Graph
+GRAPH_BATCH_LIMIT = 20
+# Por encima de 4 MiB Graph exige una sesión de carga (createUploadSession)
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+# Descargas: hasta 16 MiB se mantienen en RAM, por encima se vuelcan a disco
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Tamaño de fragmento para sesiones de carga (múltiplo de 320 KiB)
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+# Conexiones keep-alive hacia Graph; las subidas concurrentes nunca superan el pool
+GRAPH_MAX_CONNECTIONS = 32
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+# Subidas agrupadas en /$batch (GRAPH_BATCH_UPLOADS=1): el contenido viaja en base64 dentro
+# del JSON, así que solo entran archivos pequeños y con un tope de bytes por petición
+BATCH_UPLOADS = os.getenv("GRAPH_BATCH_UPLOADS") == "1"
+BATCH_UPLOAD_MAX_BYTES = 2 * 1024 * 1024
+MAX_REINTENTOS = 5
+# Tope de espera entre reintentos ante throttling cuando Graph no manda Retry-After
+MAX_ESPERA_REINTENTO = 30
+# Segundos antes de la expiración en los que el token ya se renueva
+MARGEN_RENOVACION_TOKEN = 60
+
+
+def _espera_reintento(retry_after: Optional[str], intento: int) -> float:
+    """
+    Segundos a esperar antes de reintentar una petición limitada por Graph
+
+    Respeta Retry-After, en segundos o como fecha HTTP; si no viene o no se puede
+    interpretar, backoff exponencial con jitter completo (espera aleatoria entre 0
+    y el tope del intento).
+    """
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                fecha = email.utils.parsedate_to_datetime(retry_after)
+                return max(0.0, fecha.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(MAX_ESPERA_REINTENTO, 0.5 * 2 ** intento))
+
+
+def dataframe_a_xlsx(df, sheet_name: str = 'Datos') -> bytes:
+    """
+    Serializa un DataFrame a .xlsx con xlsxwriter en modo constant_memory
+    
+    En constant_memory cada fila se vuelca al cerrar la siguiente, así que las celdas
+    deben escribirse en orden de filas. DataFrame.to_excel escribe por columnas y en
+    ese modo pierde datos, por eso aquí se escribe fila a fila con write_row.
+    Sin xlsxwriter se usa openpyxl en modo write_only, que también escribe en
+    streaming sin construir el árbol de celdas en memoria.
+    """
+    import pandas as pd
+    from io import BytesIO
+
+    buffer = BytesIO()
+    # NaN/NaT -> None: la celda queda vacía
+    valores = df.astype(object).where(pd.notna(df), None)
+
+    try:
+        import xlsxwriter
+    except ImportError:
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(sheet_name)
+        worksheet.append([str(col) for col in df.columns])
+        for valores_fila in valores.itertuples(index=False, name=None):
+            worksheet.append(valores_fila)
+        workbook.save(buffer)
+        return buffer.getvalue()
+
+    workbook = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'strings_to_urls': False,
+        'default_date_format': 'dd/mm/yyyy',
+    })
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+
+    for fila, valores_fila in enumerate(valores.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(fila, 0, valores_fila)
+
+    workbook.close()
+    return buffer.getvalue()
+
+
 class DatacampusAgent:
     def __init__(self, base_url: str = "http://localhost:8000"):
         self.base_url = base_url
         self.token_ok = False
         self.session = requests.Session()
+        self.graph_session = self._crear_sesion_graph()
         self.token = None
+        self._token_expira = 0.0
+        # Las subidas concurrentes comparten el token: solo un hilo lo renueva
+        self._token_lock = threading.Lock()
+        # IDs de carpetas ya resueltas: (parent_folder_id, nombre en minúsculas) -> folder_id
+        self._folder_cache: Dict[Tuple[Optional[str], str], str] = {}
+
+    @staticmethod
+    def _crear_sesion_graph() -> requests.Session:
+        """
+        Crea la sesión HTTP compartida para Microsoft Graph
+        
+        Reutiliza conexiones keep-alive (un solo handshake TLS por conexión) y
+        reintenta peticiones idempotentes ante 429/5xx respetando Retry-After.
+        """
+        session = requests.Session()
+        # Jitter: con muchas subidas en paralelo, las que recibieron 429 a la vez no
+        # deben reintentar todas en el mismo instante
+        retry = Retry(
+            total=5,
+            backoff_factor=0.5,
+            backoff_jitter=0.5,
+            backoff_max=MAX_ESPERA_REINTENTO,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False
+        )
+        # pool_block: con ráfagas de peticiones se espera una conexión libre del pool
+        # en lugar de abrir conexiones extra (y handshakes TLS) que luego se descartan
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=GRAPH_MAX_CONNECTIONS,
+            max_retries=retry,
+            pool_block=True
+        )
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        """Cierra las sesiones HTTP y libera las conexiones del pool"""
+        self.graph_session.close()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def token(self) -> Optional[str]:
+        return self._token
+
+    @token.setter
+    def token(self, value: Optional[str]):
+        # El header de autorización se fija una vez en la sesión de Graph
+        self._token = value
+        if value:
+            self.graph_session.headers['Authorization'] = f'Bearer {value}'
+        else:
+            self.graph_session.headers.pop('Authorization', None)
+
+    def _graph(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Petición a Graph renovando el token antes de que expire o si Graph responde 401"""
+        token = self.token
+        if token and time.monotonic() >= self._token_expira:
+            self._renovar_token(token)
+            token = self.token
+
+        response = self.graph_session.request(method, url, **kwargs)
+        if response.status_code == 401 and token:
+            response.close()
+            self._renovar_token(token)
+            response = self.graph_session.request(method, url, **kwargs)
+        return response
+
+    def _renovar_token(self, token_anterior: str) -> None:
+        with self._token_lock:
+            # Otro hilo pudo renovarlo mientras se esperaba el lock
+            if self.token == token_anterior:
+                logger.info("Token expirado o por expirar, renovando...")
+                self.autenticar()
+
+    def _post_json(self, url: str, obj: Any) -> requests.Response:
+        """POST a Graph con el cuerpo ya serializado (ver json_dumps)"""
+        return self._request_con_reintentos(
+            'POST', url,
+            data=json_dumps(obj),
+            headers={'Content-Type': 'application/json'}
+        )
 
     def autenticar(self) -> bool:
         """Realiza autenticación inicial"""
@@ -31,6 +226,7 @@ class DatacampusAgent:
             data=response.json()
 
             self.token = data.get("access_token", None)
+            self._token_expira = time.monotonic() + data.get("expires_in", 3600) - MARGEN_RENOVACION_TOKEN
 
             
             print(f"Status code: {response.status_code}")
@@ -70,11 +266,7 @@ class DatacampusAgent:
                 return folder_id
             
             # Si no existe, crear la carpeta
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/json'
-            }
-            logger.debug(f"Creando carpeta con headers: {headers}")
+            logger.debug(f"Creando carpeta '{nombre_carpeta}'")
             
             # Determinar endpoint
             if parent_folder_id:
@@ -88,11 +280,12 @@ class DatacampusAgent:
                 "@microsoft.graph.conflictBehavior": "rename"
             }
             
-            response = requests.post(url, headers=headers, json=data)
+            response = self._post_json(url, data)
             
             if response.status_code == 201:
-                folder_info = response.json()
+                folder_info = json_loads(response)
                 folder_id = folder_info.get('id')
+                self._folder_cache[(parent_folder_id, nombre_carpeta.lower())] = folder_id
                 logger.info(f"Carpeta '{nombre_carpeta}' creada exitosamente")
                 return folder_id
             else:
@@ -114,26 +307,27 @@ class DatacampusAgent:
         Returns:
             ID de la carpeta si la encuentra, None si no existe
         """
+        cache_key = (parent_folder_id, nombre_carpeta.lower())
+        if cache_key in self._folder_cache:
+            return self._folder_cache[cache_key]
+
         try:
-            headers = {
-                'Authorization': f'Bearer {self.token}'
-            }
-            
             # Determinar endpoint para listar contenido
             if parent_folder_id:
                 url = f"https://graph.microsoft.com/v1.0/me/drive/items/{parent_folder_id}/children"
             else:
                 url = "https://graph.microsoft.com/v1.0/me/drive/root/children"
             
-            response = requests.get(url, headers=headers)
+            response = self._graph('GET', url)
             
             if response.status_code == 200:
-                items = response.json().get('value', [])
+                items = json_loads(response).get('value', [])
                 
                 # Buscar carpeta por nombre
                 for item in items:
                     if (item.get('name', '').lower() == nombre_carpeta.lower() and 
                         'folder' in item):
+                        self._folder_cache[cache_key] = item.get('id')
                         return item.get('id')
                 
                 return None
@@ -145,6 +339,139 @@ class DatacampusAgent:
             logger.error(f"Error al buscar carpeta '{nombre_carpeta}': {str(e)}")
             return None
     
+    def crear_carpetas_bulk(self, names: List[str], parent_id: str = None) -> Dict[str, str]:
+        """
+        Busca o crea varias carpetas usando peticiones $batch de Microsoft Graph
+
+        Primero consulta todas las carpetas en lotes de hasta 20 sub-peticiones y
+        luego crea, también en lote, solo las que no existían.
+
+        Args:
+            names: Nombres de las carpetas
+            parent_id: ID de la carpeta padre (None para raíz)
+
+        Returns:
+            Dict {nombre: folder_id} con las carpetas encontradas o creadas
+        """
+        nombres = list(dict.fromkeys(n for n in names if n))
+        if not nombres:
+            return {}
+
+        if parent_id:
+            children_url = f"/me/drive/items/{parent_id}/children"
+        else:
+            children_url = "/me/drive/root/children"
+
+        carpetas = {
+            nombre: self._folder_cache[(parent_id, nombre.lower())]
+            for nombre in nombres if (parent_id, nombre.lower()) in self._folder_cache
+        }
+        try:
+            # 1) Buscar las carpetas existentes (las ya cacheadas no se consultan)
+            consultas = []
+            for i, nombre in enumerate(nombres):
+                if nombre in carpetas:
+                    continue
+                # OData escapa las comillas simples duplicándolas
+                nombre_odata = nombre.replace("'", "''")
+                filtro = quote(f"name eq '{nombre_odata}'")
+                consultas.append({
+                    "id": f"q{i}",
+                    "method": "GET",
+                    "url": f"{children_url}?$filter={filtro}"
+                })
+
+            # Solo se crean las carpetas cuya búsqueda respondió 200 sin coincidencias: si la
+            # búsqueda falló no se sabe si existen, y crearlas con "rename" duplicaría la carpeta
+            no_existen = set()
+            for intento in range(MAX_REINTENTOS):
+                throttled, espera = [], 0.0
+                respuestas = self._ejecutar_batch(consultas)
+                for consulta in consultas:
+                    nombre = nombres[int(consulta["id"][1:])]
+                    resp = respuestas.get(consulta["id"], {})
+                    status = resp.get("status")
+                    if status in (429, 503):
+                        throttled.append(consulta)
+                        retry_after = (resp.get("headers") or {}).get("Retry-After")
+                        espera = max(espera, _espera_reintento(retry_after, intento))
+                        continue
+                    if status != 200:
+                        logger.warning(f"Error al buscar carpeta '{nombre}': {status}")
+                        continue
+                    for item in resp.get("body", {}).get("value", []):
+                        if item.get("name", "").lower() == nombre.lower() and "folder" in item:
+                            carpetas[nombre] = item.get("id")
+                            self._folder_cache[(parent_id, nombre.lower())] = carpetas[nombre]
+                            break
+                    else:
+                        no_existen.add(nombre)
+
+                consultas = throttled
+                if not consultas or intento == MAX_REINTENTOS - 1:
+                    break
+                logger.warning(f"Graph limitó {len(consultas)} búsquedas de carpetas, reintentando en {espera:.2f}s")
+                time.sleep(espera)
+
+            for consulta in consultas:
+                logger.warning(f"No se pudo buscar la carpeta '{nombres[int(consulta['id'][1:])]}', se omite")
+
+            # 2) Crear solo las carpetas que no existían
+            creaciones = [
+                {
+                    "id": f"c{i}",
+                    "method": "POST",
+                    "url": children_url,
+                    "body": {
+                        "name": nombre,
+                        "folder": {},
+                        "@microsoft.graph.conflictBehavior": "rename"
+                    },
+                    "headers": {"Content-Type": "application/json"}
+                }
+                for i, nombre in enumerate(nombres) if nombre in no_existen
+            ]
+
+            for req_id, resp in self._ejecutar_batch(creaciones).items():
+                nombre = nombres[int(req_id[1:])]
+                if resp.get("status") == 201:
+                    carpetas[nombre] = resp.get("body", {}).get("id")
+                    self._folder_cache[(parent_id, nombre.lower())] = carpetas[nombre]
+                    logger.info(f"Carpeta '{nombre}' creada exitosamente")
+                else:
+                    logger.error(f"Error al crear carpeta '{nombre}': {resp.get('status')} - {resp.get('body')}")
+
+            return carpetas
+
+        except Exception as e:
+            logger.error(f"Excepción al crear carpetas en lote: {str(e)}")
+            return carpetas
+
+    def _ejecutar_batch(self, peticiones: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        Envía sub-peticiones a /$batch en grupos de GRAPH_BATCH_LIMIT
+
+        Args:
+            peticiones: Sub-peticiones con el formato JSON batching de Graph
+
+        Returns:
+            Dict {id: respuesta} con la respuesta de cada sub-petición
+        """
+        respuestas = {}
+
+        for inicio in range(0, len(peticiones), GRAPH_BATCH_LIMIT):
+            lote = peticiones[inicio:inicio + GRAPH_BATCH_LIMIT]
+            response = self._post_json(f"{GRAPH_BASE_URL}/$batch", {"requests": lote})
+
+            if response.status_code != 200:
+                logger.error(f"Error en petición $batch: {response.status_code} - {response.text}")
+                continue
+
+            for resp in json_loads(response).get('responses', []):
+                respuestas[resp.get('id')] = resp
+
+        return respuestas
+
     def subir_pdf(self, archivo: BinaryIO, folder_id: str = None, filename: str = None) -> bool:
         """
         Sube un archivo PDF a OneDrive
@@ -161,33 +488,226 @@ class DatacampusAgent:
             if not filename:
                 filename = "certificado.pdf"
             
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/pdf'
-            }
-            
-            # Determinar endpoint
-            if folder_id:
-                url = f"https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}:/{filename}:/content"
-            else:
-                url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{filename}:/content"
-            
             # Leer contenido del archivo
             archivo.seek(0)
             file_content = archivo.read()
             
-            response = requests.put(url, headers=headers, data=file_content)
-            
-            if response.status_code in [200, 201]:
-                logger.info(f"Archivo '{filename}' subido exitosamente")
-                return True
-            else:
-                logger.error(f"Error al subir '{filename}': {response.status_code} - {response.text}")
-                return False
+            content_type = mimetypes.guess_type(filename)[0] or 'application/pdf'
+            return self._subir_bytes(folder_id, filename, file_content, content_type)
                 
         except Exception as e:
             logger.error(f"Excepción al subir archivo '{filename}': {str(e)}")
             return False
+
+    def subir_pdf_bytes(self, content: bytes, folder_id: str = None, filename: str = None) -> bool:
+        """
+        Sube un PDF (u otro archivo, según su extensión) que ya está en memoria,
+        sin envolverlo en un archivo
+        
+        Args:
+            content: Contenido del PDF
+            folder_id: ID de la carpeta destino (None para raíz)
+            filename: Nombre del archivo
+            
+        Returns:
+            True si se subió exitosamente, False si falló
+        """
+        filename = filename or "certificado.pdf"
+        try:
+            content_type = mimetypes.guess_type(filename)[0] or 'application/pdf'
+            return self._subir_bytes(folder_id, filename, content, content_type)
+        except Exception as e:
+            logger.error(f"Excepción al subir archivo '{filename}': {str(e)}")
+            return False
+
+    def subir_pdfs_bulk(self, items: List[Tuple[str, str, bytes]]) -> List[bool]:
+        """
+        Sube varios PDFs (o ZIP de certificados) a OneDrive en paralelo
+        
+        Args:
+            items: Tuplas (folder_id, filename, contenido) a subir
+            
+        Returns:
+            Resultado de cada subida, en el mismo orden que items
+        """
+        if not items:
+            return []
+
+        def _subir(item: Tuple[str, str, bytes]) -> bool:
+            folder_id, filename, content = item
+            try:
+                content_type = mimetypes.guess_type(filename)[0] or 'application/pdf'
+                return self._subir_bytes(folder_id, filename, content, content_type)
+            except Exception as e:
+                logger.error(f"Excepción al subir archivo '{filename}': {str(e)}")
+                return False
+
+        workers = min(UPLOAD_WORKERS, GRAPH_MAX_CONNECTIONS, len(items))
+        if not BATCH_UPLOADS:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(_subir, items))
+
+        # Lotes de hasta GRAPH_BATCH_LIMIT archivos pequeños; los grandes van solos
+        grupos, grupo, tam_grupo = [], [], 0
+        for pos, (_, _, content) in enumerate(items):
+            if len(content) > BATCH_UPLOAD_MAX_BYTES:
+                grupos.append([pos])
+                continue
+            if len(grupo) == GRAPH_BATCH_LIMIT or tam_grupo + len(content) > BATCH_UPLOAD_MAX_BYTES:
+                grupos.append(grupo)
+                grupo, tam_grupo = [], 0
+            grupo.append(pos)
+            tam_grupo += len(content)
+        if grupo:
+            grupos.append(grupo)
+
+        def _subir_grupo(posiciones: List[int]) -> List[bool]:
+            if len(posiciones) == 1:
+                return [_subir(items[posiciones[0]])]
+            try:
+                return self.subir_archivos_batch([items[pos] for pos in posiciones])
+            except Exception as e:
+                logger.error(f"Excepción al subir lote de {len(posiciones)} archivos: {str(e)}")
+                return [False] * len(posiciones)
+
+        resultados = [False] * len(items)
+        with ThreadPoolExecutor(max_workers=min(workers, len(grupos))) as executor:
+            for posiciones, oks in zip(grupos, executor.map(_subir_grupo, grupos)):
+                for pos, ok in zip(posiciones, oks):
+                    resultados[pos] = ok
+        return resultados
+
+    def subir_archivos_batch(self, items: List[Tuple[str, str, bytes]]) -> List[bool]:
+        """
+        Sube archivos pequeños en una sola petición /$batch (PUT .../content por archivo)
+        
+        Los que Graph rechaza dentro del lote se reintentan uno a uno con PUT simple.
+        
+        Args:
+            items: Tuplas (folder_id, filename, contenido), como mucho GRAPH_BATCH_LIMIT
+            
+        Returns:
+            Resultado de cada subida, en el mismo orden que items
+        """
+        peticiones = []
+        for i, (folder_id, filename, content) in enumerate(items):
+            if folder_id:
+                url = f"/me/drive/items/{folder_id}:/{quote(filename)}:/content"
+            else:
+                url = f"/me/drive/root:/{quote(filename)}:/content"
+            peticiones.append({
+                "id": str(i),
+                "method": "PUT",
+                "url": url,
+                "headers": {"Content-Type": mimetypes.guess_type(filename)[0] or 'application/pdf'},
+                "body": base64.b64encode(content).decode('ascii')
+            })
+
+        respuestas = self._ejecutar_batch(peticiones)
+
+        resultados = []
+        for peticion, (folder_id, filename, content) in zip(peticiones, items):
+            if respuestas.get(peticion["id"], {}).get("status") in [200, 201]:
+                logger.info(f"Archivo '{filename}' subido exitosamente")
+                resultados.append(True)
+                continue
+            # Fallo parcial (o lote entero rechazado): solo se repite este archivo
+            resultados.append(self._subir_bytes(folder_id, filename, content, peticion["headers"]["Content-Type"]))
+        return resultados
+
+    def _subir_bytes(self, folder_id: Optional[str], filename: str, content: bytes, content_type: str) -> bool:
+        """
+        Sube contenido a OneDrive: PUT simple hasta 4 MiB, sesión de carga por encima
+        
+        Args:
+            folder_id: ID de la carpeta destino (None para raíz)
+            filename: Nombre del archivo
+            content: Contenido del archivo
+            content_type: MIME type del archivo
+            
+        Returns:
+            True si se subió exitosamente, False si falló
+        """
+        if len(content) > SIMPLE_UPLOAD_LIMIT:
+            return self._subir_con_sesion(folder_id, filename, content)
+
+        headers = {
+            'Content-Type': content_type
+        }
+
+        # Determinar endpoint
+        if folder_id:
+            url = f"{GRAPH_BASE_URL}/me/drive/items/{folder_id}:/{quote(filename)}:/content"
+        else:
+            url = f"{GRAPH_BASE_URL}/me/drive/root:/{quote(filename)}:/content"
+
+        response = self._graph('PUT', url, headers=headers, data=content)
+
+        if response.status_code in [200, 201]:
+            logger.info(f"Archivo '{filename}' subido exitosamente")
+            return True
+        else:
+            logger.error(f"Error al subir '{filename}': {response.status_code} - {response.text}")
+            return False
+
+    def _subir_con_sesion(self, folder_id: Optional[str], filename: str, content: bytes) -> bool:
+        """
+        Sube un archivo grande mediante una sesión de carga de Graph
+        
+        Los fragmentos de una misma sesión deben enviarse en orden, así que el
+        paralelismo se obtiene entre archivos (ver subir_pdfs_bulk).
+        """
+        if folder_id:
+            url = f"{GRAPH_BASE_URL}/me/drive/items/{folder_id}:/{quote(filename)}:/createUploadSession"
+        else:
+            url = f"{GRAPH_BASE_URL}/me/drive/root:/{quote(filename)}:/createUploadSession"
+
+        response = self._post_json(url, {"item": {"@microsoft.graph.conflictBehavior": "replace"}})
+        if response.status_code != 200:
+            logger.error(f"Error al crear sesión de carga para '{filename}': {response.status_code} - {response.text}")
+            return False
+
+        # La uploadUrl ya viene autenticada: no se debe enviar el token
+        upload_url = json_loads(response).get('uploadUrl')
+        # Cada fragmento es una vista sobre el contenido, no una copia de hasta UPLOAD_CHUNK_SIZE
+        vista = memoryview(content)
+        total = len(vista)
+
+        for inicio in range(0, total, UPLOAD_CHUNK_SIZE):
+            fin = min(inicio + UPLOAD_CHUNK_SIZE, total)
+            chunk_headers = {
+                'Authorization': None,
+                'Content-Length': str(fin - inicio),
+                'Content-Range': f"bytes {inicio}-{fin - 1}/{total}"
+            }
+            response = self.graph_session.put(upload_url, headers=chunk_headers, data=vista[inicio:fin])
+
+            if response.status_code not in [200, 201, 202]:
+                logger.error(f"Error al subir fragmento de '{filename}': {response.status_code} - {response.text}")
+                return False
+
+        logger.info(f"Archivo '{filename}' subido exitosamente")
+        return True
+
+    def _request_con_reintentos(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Realiza una petición HTTP reintentando cuando Graph responde 429/503
+        
+        La sesión ya reintenta los métodos idempotentes; esto cubre los POST,
+        que solo se repiten ante throttling porque Graph no los ejecutó.
+        Respeta la cabecera Retry-After; si no viene, usa backoff exponencial con
+        jitter completo (espera aleatoria entre 0 y el tope del intento).
+        """
+        for intento in range(MAX_REINTENTOS):
+            response = self._graph(method, url, **kwargs)
+            if response.status_code not in (429, 503):
+                return response
+
+            espera = _espera_reintento(response.headers.get('Retry-After'), intento)
+            logger.warning(f"Graph respondió {response.status_code}, reintentando en {espera:.2f}s")
+            time.sleep(espera)
+
+        return response
     
     def obtener_excel_como_json(self, file_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene el contenido de un archivo Excel como JSON"""
@@ -197,11 +717,101 @@ class DatacampusAgent:
         try:
             response = self.session.get(f"{self.base_url}/files/{file_id}/content")
             response.raise_for_status()
-            return response.json()
+            # Payload con toda la hoja: orjson lo parsea bastante más rápido
+            return json_loads(response)
         except Exception as e:
             print(f"Error al obtener contenido del archivo: {e}")
             return None
     
+    def obtener_excel_como_dataframe(self, file_id: str):
+        """
+        Descarga un Excel directamente de Graph y lo lee con pandas
+        
+        A diferencia de obtener_excel_como_json, no pasa por JSON ni por una copia
+        completa en memoria: pandas lee del archivo temporal de la descarga.
+        Las celdas se leen como texto y las vacías como "", igual que el camino
+        JSON, sin una pasada posterior de fillna/astype.
+        
+        Args:
+            file_id: ID del archivo en OneDrive
+            
+        Returns:
+            DataFrame con el contenido de la primera hoja, None si falla
+        """
+        spool = self._descargar_archivo_spooled(file_id)
+        if spool is None:
+            return None
+
+        try:
+            import pandas as pd
+
+            with spool:
+                return pd.read_excel(spool, engine=EXCEL_READ_ENGINE, dtype=str, na_filter=False)
+        except Exception as e:
+            logger.error(f"Error al leer Excel descargado: {str(e)}")
+            return None
+
+    def subir_dataframe_intermedio(self, df, folder_id: str = None, nombre_archivo: str = "pendientes.feather",
+                                   formato: str = "feather") -> bool:
+        """
+        Sube un DataFrame como estado intermedio en feather/parquet
+        
+        El .xlsx se reserva para la exportación final que consulta una persona;
+        para snapshots internos feather/parquet se escriben mucho más rápido y pesan menos.
+        
+        Args:
+            df: DataFrame a guardar
+            folder_id: ID de la carpeta destino (None para raíz)
+            nombre_archivo: Nombre del archivo
+            formato: "feather" o "parquet"
+            
+        Returns:
+            True si se subió exitosamente, False si falló
+        """
+        try:
+            from io import BytesIO
+
+            buffer = BytesIO()
+            if formato == "parquet":
+                df.to_parquet(buffer, index=False)
+            else:
+                # feather exige un índice por defecto
+                df.reset_index(drop=True).to_feather(buffer)
+
+            return self._subir_bytes(folder_id, nombre_archivo, buffer.getvalue(), 'application/octet-stream')
+
+        except Exception as e:
+            logger.error(f"Error al subir snapshot {formato}: {str(e)}")
+            return False
+
+    def _descargar_archivo_spooled(self, file_id: str) -> Optional[tempfile.SpooledTemporaryFile]:
+        """
+        Descarga un archivo en streaming a un SpooledTemporaryFile
+        
+        Args:
+            file_id: ID del archivo en OneDrive
+            
+        Returns:
+            Archivo temporal posicionado al inicio, None si falla
+        """
+        try:
+            url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/content"
+            with self._graph('GET', url, stream=True) as response:
+                if response.status_code != 200:
+                    logger.error(f"Error al descargar archivo: {response.status_code}")
+                    return None
+
+                spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    spool.write(chunk)
+
+            spool.seek(0)
+            return spool
+
+        except Exception as e:
+            logger.error(f"Error al descargar archivo: {str(e)}")
+            return None
+    
     def _descargar_archivo(self, file_id: str) -> Optional[bytes]:
         """
         Descarga contenido de un archivo por su ID
@@ -213,12 +823,8 @@ class DatacampusAgent:
             Contenido del archivo como bytes, None si falla
         """
         try:
-            headers = {
-                'Authorization': f'Bearer {self.token}'
-            }
-            
             url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/content"
-            response = requests.get(url, headers=headers)
+            response = self._graph('GET', url)
             
             if response.status_code == 200:
                 return response.content
@@ -248,37 +854,70 @@ class DatacampusAgent:
                 return False
             
             import pandas as pd
-            from io import BytesIO  
             
             # Crear DataFrame
             df = pd.DataFrame(datos)
             
-            # Guardar en BytesIO
-            excel_buffer = BytesIO()
-            with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Datos')
-            
-            excel_buffer.seek(0)
+            # xlsxwriter en modo constant_memory, escrito fila a fila: mucho más rápido
+            # que openpyxl para reportes grandes (CSV sigue siendo la opción más rápida,
+            # ver crear_reporte_csv)
+            content = dataframe_a_xlsx(df, sheet_name='Datos')
             
             # Subir archivo
-            headers = {
-                'Authorization': f'Bearer {self.token}',
-                'Content-Type': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            }
+            ok = self._subir_bytes(
+                folder_id,
+                nombre_archivo,
+                content,
+                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
             
-            if folder_id:
-                url = f"https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}:/{nombre_archivo}:/content"
+            if ok:
+                logger.info(f"Reporte '{nombre_archivo}' creado exitosamente")
             else:
-                url = f"https://graph.microsoft.com/v1.0/me/drive/root:/{nombre_archivo}:/content"
+                logger.error(f"Error al crear reporte '{nombre_archivo}'")
+            return ok
+                
+        except Exception as e:
+            logger.error(f"Error al crear reporte: {str(e)}")
+            return False
+
+    def crear_reporte_csv(self, folder_id: str = None, nombre_archivo: str = "reporte.csv", datos: Dict[str, list] = None) -> bool:
+        """
+        Crea y sube un reporte CSV con datos
+        
+        Alternativa rápida a crear_reporte cuando no se necesita un .xlsx:
+        serializar CSV es un orden de magnitud más rápido que escribir Excel
+        y Excel lo abre directamente.
+        
+        Args:
+            folder_id: ID de la carpeta destino
+            nombre_archivo: Nombre del archivo CSV
+            datos: Dict donde keys son nombres de columnas y values son listas de datos
             
-            response = requests.put(url, headers=headers, data=excel_buffer.getvalue())
+        Returns:
+            True si se creó exitosamente, False si falló
+        """
+        try:
+            if not datos:
+                logger.error("No hay datos para crear el reporte")
+                return False
+            
+            import pandas as pd
+            from io import BytesIO
+            
+            df = pd.DataFrame(datos)
             
-            if response.status_code in [200, 201]:
+            # utf-8-sig para que Excel detecte la codificación (tildes, ñ)
+            csv_buffer = BytesIO()
+            df.to_csv(csv_buffer, index=False, encoding='utf-8-sig')
+            
+            ok = self._subir_bytes(folder_id, nombre_archivo, csv_buffer.getvalue(), 'text/csv')
+            
+            if ok:
                 logger.info(f"Reporte '{nombre_archivo}' creado exitosamente")
-                return True
             else:
-                logger.error(f"Error al crear reporte: {response.status_code} - {response.text}")
-                return False
+                logger.error(f"Error al crear reporte '{nombre_archivo}'")
+            return ok
                 
         except Exception as e:
             logger.error(f"Error al crear reporte: {str(e)}")
@@ -288,10 +927,9 @@ class DatacampusAgent:
         try:
             url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/content"
             headers = {
-                "Authorization": f"Bearer {self.token}",
                 "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             }
-            response = requests.put(url, headers=headers, data=content)
+            response = self._graph('PUT', url, headers=headers, data=content)
             if response.status_code in (200, 201):
                 return True
             else:
@@ -302,15 +940,37 @@ class DatacampusAgent:
             return False
 
     
+    def obtener_etag(self, file_id: str) -> Optional[str]:
+        """
+        Obtiene el eTag de un archivo (cambia con cada modificación)
+        
+        Solo pide los metadatos, así que es mucho más barato que descargar el archivo.
+        
+        Args:
+            file_id: ID del archivo en OneDrive
+            
+        Returns:
+            eTag del archivo, None si falla
+        """
+        try:
+            url = f"{GRAPH_BASE_URL}/me/drive/items/{file_id}?$select=eTag"
+            response = self._graph('GET', url)
+
+            if response.status_code != 200:
+                logger.error(f"Error al obtener eTag: {response.status_code}")
+                return None
+
+            return json_loads(response).get('eTag')
+
+        except Exception as e:
+            logger.error(f"Error al obtener eTag: {str(e)}")
+            return None
+
     def validar_token(self) -> bool:
         try:
-            headers = {
-                'Authorization': f'Bearer {self.token}'
-            }
-            
             # Hacer una llamada simple para validar el token
             url = "https://graph.microsoft.com/v1.0/me"
-            response = requests.get(url, headers=headers)
+            response = self._graph('GET', url)
             
             return response.status_code == 200
             
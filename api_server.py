@@ -1,14 +1,22 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import pandas as pd
 import io
 import json
+import os
+import time
+import uuid
+import asyncio
+import zipfile
 from datetime import datetime
 from auth.auth_manager import AuthManager
+from config import EXCEL_READ_ENGINE, CertificadosConfig
+from core.certificados import generar_certificados_desde_excel
 from one_drive.OD_manager import *
+from core.json_graph import json_dumps
 from one_drive.OD_manager import OneDriveManager
 
 app = FastAPI(
@@ -29,6 +37,18 @@ app.add_middleware(
 # Instancia global del manager (en producción usar dependency injection)
 od_manager = None
 
+# Trabajos de generación de certificados en segundo plano: job_id -> estado
+certificados_jobs: Dict[str, Dict[str, Any]] = {}
+# Segundos que se conserva un trabajo terminado (y su ZIP en memoria) antes de descartarlo
+CERTIFICADOS_JOB_TTL = int(os.getenv("CERTIFICADOS_JOB_TTL", "3600"))
+# Cada trabajo ya usa un pool de procesos del tamaño de la CPU (y un soffice por worker):
+# los demás esperan en cola
+MAX_JOBS_SIMULTANEOS = int(os.getenv("MAX_JOBS_SIMULTANEOS", "1"))
+_jobs_semaforo = asyncio.Semaphore(MAX_JOBS_SIMULTANEOS)
+# El API no exige EXCEL_FILE_ID, así que no usa CertificadosConfig.from_env; sí el mismo
+# RENDER_BACKEND y su valor por defecto
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", CertificadosConfig.render_backend)
+
 class ItemResponse(BaseModel):
     id: str
     name: str
@@ -54,6 +74,10 @@ class CreateFolderRequest(BaseModel):
     folder_name: str
     parent_folder_id: Optional[str] = None
     
+class CreateFoldersBatchRequest(BaseModel):
+    folder_names: List[str]
+    parent_folder_id: Optional[str] = None
+
 class UpdateExcelRequest(BaseModel):
     file_id: str
     data: Dict[str, List[Any]]
@@ -63,6 +87,17 @@ class AuthResponse(BaseModel):
     message: str
     expires_in: Optional[int] = None
 
+class JobResponse(BaseModel):
+    job_id: str
+    status_url: str
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    state: str
+    total_certificados: Optional[int] = None
+    result_zip_url: Optional[str] = None
+    error: Optional[str] = None
+
 # Dependency para verificar autenticación
 async def get_manager():
     global od_manager
@@ -227,9 +262,15 @@ async def get_file_content(
 ):
     try:
         df = od_manager.read_excel_file(file_id)
-        # Convertir DataFrame → lista de diccionarios
+        # Convertir DataFrame → lista de diccionarios. orjson solo acepta claves str y
+        # una hoja leída sin encabezado trae columnas numéricas (0, 1, 2...)
+        df.columns = df.columns.map(str)
         data = df.astype(str).to_dict(orient="records")
-        return {"status": "success", "rows": len(data), "data": data}
+        # Respuesta ya serializada (orjson si está instalado): evita pasar cada celda por jsonable_encoder
+        return Response(
+            content=json_dumps({"status": "success", "rows": len(data), "data": data}),
+            media_type="application/json"
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -277,7 +318,7 @@ async def upload_file(
         
         # Leer contenido del archivo
         content = await file.read()
-        df = pd.read_excel(io.BytesIO(content))
+        df = pd.read_excel(io.BytesIO(content), engine=EXCEL_READ_ENGINE)
         
         # Crear archivo en OneDrive
         result = manager.create_excel_file(folder_id, file.filename, df)
@@ -287,6 +328,112 @@ async def upload_file(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al subir archivo: {str(e)}")
 
+@app.post("/files/batch")
+async def upload_files_batch(
+    files: List[UploadFile] = File(...),
+    folder_id: Optional[str] = Form(None),
+    manager: OneDriveManager = Depends(get_manager)
+):
+    """Sube varios archivos a una carpeta en paralelo sobre la sesión compartida"""
+    try:
+        folder_id = folder_id or manager.datacampus_root_id
+        contenidos = [(file.filename, await file.read()) for file in files]
+
+        # upload_files es bloqueante (hilos + requests): fuera del event loop
+        resultados = await asyncio.to_thread(manager.upload_files, folder_id, contenidos)
+
+        subidos = [
+            {"filename": filename, "file_id": resultado["id"]}
+            for (filename, _), resultado in zip(contenidos, resultados) if resultado
+        ]
+        fallidos = [filename for (filename, _), resultado in zip(contenidos, resultados) if not resultado]
+        return {"message": f"{len(subidos)} de {len(contenidos)} archivos subidos", "files": subidos, "failed": fallidos}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al subir archivos: {str(e)}")
+
+# Endpoints de generación de certificados (en segundo plano)
+def _purgar_jobs_vencidos():
+    """Descarta los trabajos terminados hace más de CERTIFICADOS_JOB_TTL segundos"""
+    limite = time.monotonic() - CERTIFICADOS_JOB_TTL
+    vencidos = [
+        job_id for job_id, job in certificados_jobs.items()
+        if job["finished_at"] is not None and job["finished_at"] < limite
+    ]
+    for job_id in vencidos:
+        del certificados_jobs[job_id]
+
+async def _ejecutar_job_certificados(job_id: str, content: bytes):
+    """Genera los certificados de un Excel subido y guarda un ZIP con el resultado"""
+    job = certificados_jobs[job_id]
+    async with _jobs_semaforo:
+        job["state"] = "running"
+        try:
+            df = await asyncio.to_thread(pd.read_excel, io.BytesIO(content), engine=EXCEL_READ_ENGINE)
+            certificados_por_compania, df_actualizado = await generar_certificados_desde_excel(df, render_backend=RENDER_BACKEND)
+
+            # PDFs ya comprimidos: ZIP_STORED evita recomprimirlos
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
+                for compania, archivos in certificados_por_compania.items():
+                    for archivo in archivos:
+                        zf.writestr(f"{compania}/{archivo['filename']}", archivo["content"])
+
+            job["result"] = zip_buffer.getvalue()
+            job["total_certificados"] = sum(len(v) for v in certificados_por_compania.values())
+            job["state"] = "finished"
+        except Exception as e:
+            print(f" Error en trabajo de certificados {job_id}: {str(e)}")
+            job["error"] = str(e)
+            job["state"] = "failed"
+    job["finished_at"] = time.monotonic()
+
+@app.post("/certificados/jobs", response_model=JobResponse)
+async def crear_job_certificados(excel_file: UploadFile = File(...)):
+    """Encola la generación de certificados y retorna de inmediato el ID del trabajo"""
+    if not excel_file.filename.endswith(('.xlsx', '.xls')):
+        raise HTTPException(status_code=400, detail="Solo se permiten archivos Excel (.xlsx, .xls)")
+
+    content = await excel_file.read()
+    _purgar_jobs_vencidos()
+    job_id = uuid.uuid4().hex
+    certificados_jobs[job_id] = {
+        "state": "queued", "result": None, "total_certificados": None, "error": None, "finished_at": None
+    }
+    # Se guarda la referencia a la tarea para que no sea recolectada antes de terminar
+    certificados_jobs[job_id]["task"] = asyncio.create_task(_ejecutar_job_certificados(job_id, content))
+
+    return JobResponse(job_id=job_id, status_url=f"/status/{job_id}")
+
+@app.get("/status/{job_id}", response_model=JobStatusResponse)
+async def estado_job_certificados(job_id: str):
+    _purgar_jobs_vencidos()
+    job = certificados_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo '{job_id}' no encontrado")
+
+    return JobStatusResponse(
+        job_id=job_id,
+        state=job["state"],
+        total_certificados=job["total_certificados"],
+        result_zip_url=f"/certificados/jobs/{job_id}/result" if job["state"] == "finished" else None,
+        error=job["error"]
+    )
+
+@app.get("/certificados/jobs/{job_id}/result")
+async def resultado_job_certificados(job_id: str):
+    _purgar_jobs_vencidos()
+    job = certificados_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo '{job_id}' no encontrado")
+    if job["state"] != "finished":
+        raise HTTPException(status_code=409, detail=f"El trabajo aún no ha terminado (estado: {job['state']})")
+
+    return StreamingResponse(
+        io.BytesIO(job["result"]),
+        media_type="application/zip",
+        headers={"Content-Disposition": f"attachment; filename=certificados_{job_id}.zip"}
+    )
+
 # Endpoints CRUD para carpetas
 @app.post("/folders")
 async def create_folder(
@@ -300,6 +447,18 @@ async def create_folder(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al crear carpeta: {str(e)}")
 
+@app.post("/folders/batch")
+async def create_folders_batch(
+    request: CreateFoldersBatchRequest,
+    manager: OneDriveManager = Depends(get_manager)
+):
+    try:
+        parent_folder_id = request.parent_folder_id or manager.datacampus_root_id
+        folders = manager.create_folders_batch(parent_folder_id, request.folder_names)
+        return {"message": f"{len(folders)} carpetas creadas", "folders": folders}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al crear carpetas: {str(e)}")
+
 # Endpoints de eliminación
 @app.delete("/items/{item_id}")
 async def delete_item(
@@ -321,10 +480,11 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "auth": "/auth/login, /auth/status",
-            "folders": "/folders, /folders (POST)",
+            "folders": "/folders, /folders (POST), /folders/batch (POST)",
             "files": "/files/excel (POST), /files/{id}/content, /files/{id}/download",
             "items": "/items/{id}, /items/{id} (DELETE)",
             "search": "/search/{name}",
+            "certificados": "/certificados/jobs (POST), /status/{job_id}, /certificados/jobs/{job_id}/result",
             "docs": "/docs"
         }
     }
@@ -39,17 +39,25 @@ class AuthManager:
 
     def _save_cache(self):
         if self.cache.has_state_changed:
-            with open(self.cache_path, 'wb') as f:
+            # El caché guarda el refresh token: solo legible por el usuario (0o600).
+            # Se escribe en un temporal y se reemplaza para no dejarlo a medias
+            tmp_path = f"{self.cache_path}.tmp"
+            fd = os.open(tmp_path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
                 f.write(self.cache.serialize().encode("utf-8"))
+            os.replace(tmp_path, self.cache_path)
+            self.cache.has_state_changed = False
 
-    def get_token(self, force_auth: bool = False) -> dict:
+    def get_token(self, force_auth: bool = False, force_refresh: bool = False) -> dict:
         if not force_auth:
             accounts = self.app.get_accounts()
             if accounts:
-                result = self.app.acquire_token_silent(SCOPES, account=accounts[0])
+                # force_refresh: ignora el access token en caché y usa el refresh token
+                result = self.app.acquire_token_silent(SCOPES, account=accounts[0], force_refresh=force_refresh)
                 if result and "access_token" in result:
                     print("Token obtenido silenciosamente.")
                     self.token = result
+                    self._save_cache()
                     return result
 
         print(" Iniciando autenticación interactiva...")
@@ -5,6 +5,18 @@ from dotenv import load_dotenv
 
 
 load_dotenv()
+
+# Columnas que usa el render de certificados; las demás columnas del Excel se conservan
+# y se vuelven a escribir, solo el render trabaja sobre estas
+EXPECTED_COLS = ["certificado", "compañia", "nombre", "cedula", "fecha", "horas"]
+
+try:
+    import python_calamine  # noqa: F401
+    # Lector nativo (Rust): mucho más rápido que openpyxl para leer hojas grandes
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = 'openpyxl'
+
 @dataclass
 class CertificadosConfig:
     """Configuración para el sistema de certificados"""
@@ -15,8 +27,9 @@ class CertificadosConfig:
     
     # Archivos locales
     plantilla_path: str = "plantilla.docx"
-    temp_folder: str = "temp_pdfs"
     log_file: str = "certificados_log.log"
+    # Render de certificados: "libreoffice" (docxtpl) o "reportlab" (texto sobre plantilla.pdf)
+    render_backend: str = "libreoffice"
     
     # Columnas esperadas en Excel
     columna_certificado: str = "certificado"
@@ -43,8 +56,8 @@ class CertificadosConfig:
             excel_file_id=excel_file_id,
             certificados_folder_id=os.getenv("CERTIFICADOS_FOLDER_ID", cls.certificados_folder_id),
             plantilla_path=os.getenv("PLANTILLA_PATH", cls.plantilla_path),
-            temp_folder=os.getenv("TEMP_FOLDER", cls.temp_folder),
             log_file=os.getenv("LOG_FILE", cls.log_file),
+            render_backend=os.getenv("RENDER_BACKEND", cls.render_backend),
             columna_certificado=os.getenv("COLUMNA_CERTIFICADO", cls.columna_certificado),
             columna_empresa=os.getenv("COLUMNA_EMPRESA", cls.columna_empresa),
             columna_nombre=os.getenv("COLUMNA_NOMBRE", cls.columna_nombre),
@@ -1,106 +1,379 @@
 from asyncio.log import logger
+import hashlib
 import io
 import os
 import platform
+import re
 import subprocess
 import tempfile
+from functools import lru_cache
+from pathlib import Path
 import pandas as pd
 from docxtpl import DocxTemplate
+from jinja2 import Template
 from datetime import datetime
 from collections import defaultdict
 import asyncio
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor
 from docx2pdf import convert  # solo Windows
+from config import EXCEL_READ_ENGINE, EXPECTED_COLS
+from core.libreoffice_pool import convert_docx_bytes_to_pdf_bytes, detener_libreoffice
 
 ON_WINDOWS = platform.system() == "Windows"
+PLANTILLA_PATH = "plantilla.docx"
+# Backend de conversión DOCX -> PDF: "libreoffice", "docx2pdf" o "simulado"
+PDF_BACKEND = os.getenv("PDF_BACKEND", "simulado" if ON_WINDOWS else "libreoffice")
+PLANTILLA_PDF_PATH = os.getenv("PLANTILLA_PDF_PATH", "plantilla.pdf")
+# Posición de cada campo sobre el fondo, como fracción del ancho/alto de la página
+# (centrado en x). Ajustar si cambia el diseño de plantilla.docx.
+POSICIONES_TEXTO = {
+    "NOMBRE": (0.5, 0.66, "Helvetica-Bold", 22),
+    "CEDULA": (0.5, 0.49, "Helvetica", 14),
+    "FECHA": (0.5, 0.40, "Helvetica", 14),
+}
+# Espacios y caracteres no válidos en rutas -> "_" en una sola pasada
+_SAFE = str.maketrans({" ": "_", "/": "_", "\\": "_", ":": "_"})
 
-async def generar_certificados_desde_excel(excel_input) -> tuple[dict, pd.DataFrame]:
+
+@lru_cache(maxsize=None)
+def _plantilla_bytes(path: str = PLANTILLA_PATH) -> bytes:
+    """Lee la plantilla una sola vez; cada certificado se renderiza desde una copia en memoria"""
+    return Path(path).read_bytes()
+
+
+class CachedDocxTemplate(DocxTemplate):
+    """
+    DocxTemplate que compila el XML de la plantilla a Jinja una sola vez por proceso.
+
+    DocxTemplate.render serializa el XML del cuerpo, cabeceras y pies, aplica las
+    sustituciones de patch_xml y compila el resultado con Jinja en cada render.
+    Como la plantilla es fija, las plantillas Jinja compiladas se guardan por
+    (SHA1 de la plantilla, parte) y cada fila solo las renderiza con su contexto.
+    """
+
+    _compiladas: dict = {}
+
+    def __init__(self, template_bytes: bytes):
+        super().__init__(io.BytesIO(template_bytes))
+        self._clave = hashlib.sha1(template_bytes).hexdigest()
+
+    def _compilar(self, parte: str, obtener_xml) -> Template:
+        clave = (self._clave, parte)
+        compilada = self._compiladas.get(clave)
+        if compilada is None:
+            src_xml = self.patch_xml(obtener_xml())
+            src_xml = re.sub(r"<w:p([ >])", r"\n<w:p\1", src_xml)
+            compilada = self._compiladas[clave] = Template(src_xml)
+        return compilada
+
+    def _render_compilada(self, compilada: Template, part, context) -> str:
+        # Mismo post-proceso que DocxTemplate.render_xml_part
+        self.current_rendering_part = part
+        dst_xml = compilada.render(context)
+        dst_xml = re.sub(r"\n<w:p([ >])", r"<w:p\1", dst_xml)
+        dst_xml = (
+            dst_xml.replace("{_{", "{{")
+            .replace("}_}", "}}")
+            .replace("{_%", "{%")
+            .replace("%_}", "%}")
+        )
+        return self.resolve_listing(dst_xml)
+
+    def build_xml(self, context, jinja_env=None):
+        if jinja_env is not None:
+            return super().build_xml(context, jinja_env)
+        compilada = self._compilar("body", self.get_xml)
+        return self._render_compilada(compilada, self.docx._part, context)
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        if jinja_env is not None:
+            yield from super().build_headers_footers_xml(context, uri, jinja_env)
+            return
+        for relKey, part in self.get_headers_footers(uri):
+            xml = self.get_part_xml(part)
+            encoding = self.get_headers_footers_encoding(xml)
+            compilada = self._compilar(f"{uri}:{relKey}", lambda: xml)
+            yield relKey, self._render_compilada(compilada, part, context).encode(encoding)
+
+
+def _docx2pdf_bytes(docx_bytes: bytes) -> bytes:
+    """Conversión con Word vía docx2pdf: solo acepta rutas, un DOCX y un PDF en disco"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_path = os.path.join(tmp_dir, "certificado.docx")
+        pdf_path = os.path.join(tmp_dir, "certificado.pdf")
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+
+        convert(docx_path, pdf_path)
+
+        with open(pdf_path, "rb") as f:
+            return f.read()
+
+
+def docx_bytes_to_pdf_bytes(docx_bytes: bytes) -> bytes:
+    """Convierte un DOCX en memoria a PDF con el backend configurado en PDF_BACKEND"""
+    if PDF_BACKEND == "libreoffice":
+        # LibreOffice persistente del proceso, sin tocar disco cuando hay UNO
+        return convert_docx_bytes_to_pdf_bytes(docx_bytes)
+    if PDF_BACKEND == "docx2pdf":
+        return _docx2pdf_bytes(docx_bytes)
+
+    # Simulado: no hay conversión real, se devuelve el DOCX sin pasar por disco
+    logger.info("Simulando conversion a PDF")
+    return docx_bytes
+
+
+def _generar_fondo_pdf(path: str = PLANTILLA_PDF_PATH) -> bytes:
+    """
+    Obtiene el fondo para el backend reportlab: si no existe plantilla.pdf se genera
+    una sola vez renderizando plantilla.docx con los campos vacíos y convirtiéndola.
+    """
+    fondo = Path(path)
+    if not fondo.exists():
+        if PDF_BACKEND not in ("libreoffice", "docx2pdf"):
+            # Con el backend simulado saldría un DOCX llamado plantilla.pdf
+            raise RuntimeError(
+                f"No existe {path} y PDF_BACKEND={PDF_BACKEND!r} no convierte a PDF: "
+                "genere el fondo con libreoffice o docx2pdf, o colóquelo manualmente"
+            )
+        logger.info(f" Generando fondo {path} a partir de {PLANTILLA_PATH}...")
+        plantilla = DocxTemplate(io.BytesIO(_plantilla_bytes()))
+        plantilla.render({campo: "" for campo in _CONTEXTO})
+        docx_buffer = io.BytesIO()
+        plantilla.save(docx_buffer)
+        pdf_bytes = docx_bytes_to_pdf_bytes(docx_buffer.getvalue())
+        if not pdf_bytes.startswith(b"%PDF"):
+            raise RuntimeError(f"La conversión de {PLANTILLA_PATH} no produjo un PDF válido; no se guarda {path}")
+        fondo.write_bytes(pdf_bytes)
+    return _plantilla_bytes(path)
+
+
+@lru_cache(maxsize=1)
+def _pagina_fondo(fondo_bytes: bytes):
+    from pypdf import PdfReader
+    return PdfReader(io.BytesIO(fondo_bytes)).pages[0]
+
+
+def _render_reportlab(fondo_bytes: bytes, contexto: dict) -> bytes:
+    """Estampa los campos sobre el fondo PDF: sin docx, Jinja ni LibreOffice por fila"""
+    from pypdf import PdfReader, PdfWriter
+    from reportlab.pdfgen import canvas
+
+    fondo = _pagina_fondo(fondo_bytes)
+    ancho, alto = float(fondo.mediabox.width), float(fondo.mediabox.height)
+
+    overlay_buffer = io.BytesIO()
+    lienzo = canvas.Canvas(overlay_buffer, pagesize=(ancho, alto))
+    for campo, (x, y, fuente, tamano) in POSICIONES_TEXTO.items():
+        lienzo.setFont(fuente, tamano)
+        lienzo.drawCentredString(x * ancho, y * alto, str(contexto.get(campo) or ""))
+    lienzo.save()
+    overlay_buffer.seek(0)
+
+    writer = PdfWriter()
+    pagina = writer.add_page(fondo)
+    pagina.merge_page(PdfReader(overlay_buffer).pages[0])
+    pdf_buffer = io.BytesIO()
+    writer.write(pdf_buffer)
+    return pdf_buffer.getvalue()
+
+
+# Plantilla (o fondo PDF) y backend de render del worker: se reciben una vez al arrancar,
+# no en cada tarea
+_TEMPLATE_BYTES = None
+_RENDER_BACKEND = "libreoffice"
+# Lotes por worker: varios por proceso para repartir bien si unas filas tardan más
+LOTES_POR_WORKER = 4
+
+
+def _inicializar_worker(template_bytes: bytes = None, render_backend: str = "libreoffice"):
+    global _TEMPLATE_BYTES, _RENDER_BACKEND
+    _TEMPLATE_BYTES = template_bytes
+    _RENDER_BACKEND = render_backend
+    # Los workers terminan sin pasar por atexit: cerrar su LibreOffice al salir
+    multiprocessing.util.Finalize(None, detener_libreoffice, exitpriority=10)
+
+
+# Contexto reutilizado por cada worker: render es síncrono dentro del proceso,
+# así que basta reasignar los valores en lugar de crear un dict por fila
+_CONTEXTO = {"NOMBRE": None, "CEDULA": None, "HORAS": None, "COMPANIA": None, "FECHA": None}
+
+
+def _render_one(template_bytes: bytes, render_backend: str, fila: tuple, nombre_base: str) -> tuple[str, str, bytes]:
+    """Renderiza y convierte un certificado; se ejecuta en un proceso del pool"""
+    contexto = _CONTEXTO
+    contexto["NOMBRE"], contexto["CEDULA"], contexto["HORAS"], contexto["COMPANIA"], contexto["FECHA"] = fila
+
+    # Renderizar DOCX en memoria desde los bytes de la plantilla
+    logger.info(f" Generando certificado para {contexto['NOMBRE']}...")
+    if render_backend == "reportlab":
+        # template_bytes es el fondo PDF
+        return contexto["COMPANIA"], nombre_base, _render_reportlab(template_bytes, contexto)
+
+    plantilla = CachedDocxTemplate(template_bytes)
+    plantilla.render(contexto)
+    with io.BytesIO() as docx_buffer:
+        plantilla.save(docx_buffer)
+        docx_bytes = docx_buffer.getvalue()
+
+    return contexto["COMPANIA"], nombre_base, docx_bytes_to_pdf_bytes(docx_bytes)
+
+
+def _render_lote(lote: list) -> list:
+    """
+    Renderiza un lote de filas en el worker; cada fila falla por separado.
+    Los errores vuelven como RuntimeError con el mensaje (siempre serializable).
+    """
+    resultados = []
+    for fila, nombre_base in lote:
+        try:
+            resultados.append(_render_one(_TEMPLATE_BYTES, _RENDER_BACKEND, fila, nombre_base))
+        except Exception as e:
+            resultados.append(RuntimeError(str(e)))
+    return resultados
+
+
+def filas_pendientes(df: pd.DataFrame) -> pd.Series:
+    """Máscara de las filas cuyo certificado sigue pendiente ('no', sin distinguir mayúsculas)"""
+    # Como categórica solo se normalizan los valores distintos (pocos), y si "no" no
+    # aparece entre ellos no se recorre la columna
+    certificado = df["certificado"]
+    if not isinstance(certificado.dtype, pd.CategoricalDtype):
+        certificado = certificado.astype("category")
+    valores_pendientes = [c for c in certificado.cat.categories if str(c).lower() == "no"]
+    if not valores_pendientes:
+        return pd.Series(False, index=df.index)
+    return certificado.isin(valores_pendientes)
+
+
+async def generar_certificados_desde_excel(excel_input, al_completar_compania=None,
+                                          render_backend: str = "libreoffice") -> tuple[dict, pd.DataFrame]:
+    # render_backend: "libreoffice" (docxtpl + conversión) o "reportlab" (texto sobre un
+    # fondo PDF fijo); lo decide quien llama, p. ej. desde CertificadosConfig.render_backend
+    # al_completar_compania(compania, certificados): se llama en el event loop en cuanto se
+    # renderiza la última fila pendiente de una compañía, sin esperar al resto. Debe
+    # volver enseguida (p. ej. encolar la subida en un executor)
 
 
     # === 1) Convertimos excel_input a DataFrame ===
     if isinstance(excel_input, (str, os.PathLike)):
-        df = pd.read_excel(excel_input)
+        # Se lee la hoja completa: el DataFrame devuelto es el que se vuelve a subir y no
+        # debe perder columnas. Solo el render trabaja con las columnas de EXPECTED_COLS
+        df = pd.read_excel(
+            excel_input,
+            engine=EXCEL_READ_ENGINE,
+            dtype={"certificado": "category", "nombre": "string", "cedula": "string", "compañia": "string"},
+        )
+    elif isinstance(excel_input, pd.DataFrame):
+        df = excel_input
     elif isinstance(excel_input, dict) and "columns" in excel_input and "data" in excel_input:
         df = pd.DataFrame(excel_input["data"], columns=excel_input["columns"])
     else:
-        raise ValueError("excel_input debe ser ruta a Excel o un dict con columnas y data")
+        raise ValueError("excel_input debe ser ruta a Excel, DataFrame o un dict con columnas y data")
 
     # Validar columna 'certificado'
     if "certificado" not in df.columns:
         raise ValueError("El archivo no contiene la columna 'certificado'")
 
+    # Hoja sin filas: nada que convertir ni marcar
+    if df.empty:
+        return {}, df
+
     # Si no hay pendientes, retornar vacío
-    if not (df["certificado"].astype(str).str.lower() == "no").any():
+    mask = filas_pendientes(df)
+    if not mask.any():
         return {}, df
 
-    plantilla = DocxTemplate("plantilla.docx")
+    template_bytes = _generar_fondo_pdf() if render_backend == "reportlab" else _plantilla_bytes()
     certificados_por_compania = defaultdict(list)
-    
-
-    # === 2) Procesar cada fila pendiente ===
-    for idx, row in df.iterrows():
-        if str(row["certificado"]).lower() == "no":
-            fecha_val = row.get("fecha", "")
-            fecha_fmt = ""
-            if pd.notna(fecha_val) and fecha_val != "":
-                try:
-                    if isinstance(fecha_val, str):
-                        # Intento parsear con pandas
-                        fecha_dt = pd.to_datetime(fecha_val, errors="coerce")
-                    else:
-                        fecha_dt = fecha_val
-                    if pd.notna(fecha_dt):
-                        fecha_fmt = fecha_dt.strftime("%d/%m/%Y")
-                except Exception:
-                    fecha_fmt = str(fecha_val)
-
-            contexto = {
-                "NOMBRE": row.get("nombre", ""),
-                "CEDULA": row.get("cedula", ""),
-                "HORAS": row.get("horas", ""),
-                "COMPANIA": row.get("compañia", ""),
-                "FECHA": fecha_fmt,
-            }
-
-
-            nombre_base = f"certificado_{contexto['NOMBRE'].replace(' ', '_')}.pdf"
-
-            # Crear DOCX temporal
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".docx") as tmp_docx:
-                logger.info(f" Generando certificado para {contexto['NOMBRE']}...")
-                plantilla.render(contexto)
-                logger.info(f" Render FULL")
-                plantilla.save(tmp_docx.name)
-                logger.info(f"  - DOCX generado en {tmp_docx.name}")
-
-                # Crear PDF temporal
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                    if ON_WINDOWS:
-                        # docx2pdf
-                        #await asyncio.to_thread(convert, tmp_docx.name, tmp_pdf.name)
-                        logger.info("Simulando conversion a PDF (Windows)")
-                    else:
-                        # LibreOffice
-                        process = await asyncio.create_subprocess_exec(
-                            "soffice", "--headless", "--convert-to", "pdf",
-                            "--outdir", os.path.dirname(tmp_pdf.name), tmp_docx.name
-                        )
-                        await process.communicate()
-
-                    # Leer PDF en memoria
-                    with open(tmp_docx.name, "rb") as f:
-                        pdf_bytes = f.read()
-
-                    certificados_por_compania[contexto["COMPANIA"]].append({
-                        "filename": nombre_base,
-                        "content": pdf_bytes
-                    })
-
-                # Limpieza
-                os.remove(tmp_docx.name)
-                os.remove(tmp_pdf.name)
-
-            # === 3) Marcar certificado como generado ===
-            df.at[idx, "certificado"] = "si"
+
+    # === 2) Preprocesar columnas de las filas pendientes (vectorizado) ===
+    pending = df.loc[mask, [col for col in EXPECTED_COLS if col in df.columns]].copy()
+    for col in ("nombre", "cedula", "horas", "compañia", "fecha"):
+        if col not in pending.columns:
+            pending[col] = ""
+
+    fechas = pd.to_datetime(pending["fecha"].replace("", None), errors="coerce", format="mixed")
+    pending["fecha_fmt"] = fechas.dt.strftime("%d/%m/%Y").fillna("")
+    safe_nombres = pending["nombre"].fillna("").astype(str).str.translate(_SAFE)
+
+    # === 3) Columnas como arrays (SoA): una tupla por fila, sin dicts ni lookups ===
+    nombres = pending["nombre"].to_numpy()
+    cedulas = pending["cedula"].to_numpy()
+    horas = pending["horas"].to_numpy()
+    companias = pending["compañia"].to_numpy()
+    fechas_fmt = pending["fecha_fmt"].to_numpy()
+    nombres_base = ("certificado_" + safe_nombres + ".pdf").to_numpy()
+
+    filas = list(zip(nombres, cedulas, horas, companias, fechas_fmt))
+
+    # === 4) Renderizar y convertir en paralelo, por lotes de filas ===
+    # Una tarea por fila pagaba IPC y el envío de la plantilla en cada certificado;
+    # la plantilla va ahora en el initializer y cada tarea lleva un lote
+    loop = asyncio.get_running_loop()
+    max_workers = min(os.cpu_count() or 1, len(filas))
+    tareas = list(zip(filas, nombres_base))
+    tam_lote = -(-len(tareas) // (max_workers * LOTES_POR_WORKER))
+
+    # Posiciones de cada compañía: cuando se completan todas, su lote queda listo
+    posiciones = defaultdict(list)
+    for pos, compania in enumerate(companias):
+        posiciones[compania].append(pos)
+    restantes = {compania: len(pos) for compania, pos in posiciones.items()}
+    resultados = [None] * len(tareas)
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_inicializar_worker, initargs=(template_bytes, render_backend)
+    ) as pool:
+        lotes = {
+            loop.run_in_executor(pool, _render_lote, tareas[inicio:inicio + tam_lote]): inicio
+            for inicio in range(0, len(tareas), tam_lote)
+        }
+        while lotes:
+            hechos, _ = await asyncio.wait(lotes, return_when=asyncio.FIRST_COMPLETED)
+            for futuro in hechos:
+                inicio = lotes.pop(futuro)
+                lote = futuro.result()
+                resultados[inicio:inicio + len(lote)] = lote
+                if al_completar_compania is None:
+                    continue
+                for pos in range(inicio, inicio + len(lote)):
+                    compania = companias[pos]
+                    restantes[compania] -= 1
+                    if restantes[compania]:
+                        continue
+                    certificados = [
+                        {"filename": resultados[p][1], "content": resultados[p][2], "fila": pending.index[p]}
+                        for p in posiciones[compania] if not isinstance(resultados[p], Exception)
+                    ]
+                    if certificados:
+                        al_completar_compania(compania, certificados)
+
+    # Solo se marcan las filas cuyo certificado se generó: un fallo no tumba el lote
+    done_idx = []
+    for idx, resultado in zip(pending.index, resultados):
+        if isinstance(resultado, Exception):
+            logger.error(f" Error generando certificado de la fila {idx}: {resultado}")
+            continue
+        compania, nombre_base, pdf_bytes = resultado
+        # "fila": índice en df, para que quien sube pueda dejar pendiente la fila si falla
+        certificados_por_compania[compania].append({
+            "filename": nombre_base,
+            "content": pdf_bytes,
+            "fila": idx
+        })
+        done_idx.append(idx)
+
+    # Si no salió ninguno el problema es del entorno (p. ej. sin soffice), no de las filas:
+    # se informa como error en lugar de devolver un resultado vacío que parece "sin pendientes"
+    if not done_idx:
+        raise RuntimeError(f"No se pudo generar ninguno de los {len(resultados)} certificados pendientes")
+
+    # === 5) Marcar certificados como generados en una sola asignación ===
+    if isinstance(df["certificado"].dtype, pd.CategoricalDtype) and "si" not in df["certificado"].cat.categories:
+        df["certificado"] = df["certificado"].cat.add_categories(["si"])
+    df.loc[done_idx, "certificado"] = "si"
 
     return certificados_por_compania, df
 
@@ -0,0 +1,30 @@
+"""
+json_graph.py - Serialización JSON de las peticiones y respuestas de Microsoft Graph
+
+orjson si está instalado (trabaja directo sobre bytes, varias veces más rápido);
+si no, la librería estándar.
+"""
+
+import json
+from typing import Any
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Serializa el cuerpo JSON de una petición a Graph"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+
+def json_loads(response: requests.Response) -> Any:
+    """Parsea la respuesta de Graph directamente desde los bytes"""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
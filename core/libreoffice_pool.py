@@ -0,0 +1,214 @@
+"""
+libreoffice_pool.py - Conversión DOCX -> PDF con un LibreOffice persistente
+
+Se lanza un único `soffice --headless` por proceso y se reutiliza vía UNO para
+todas las conversiones, en lugar de arrancar LibreOffice por cada certificado.
+Si python-uno no está instalado se usa `soffice --convert-to` por documento.
+"""
+
+import atexit
+import io
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+try:
+    import uno
+    import unohelper
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+    from com.sun.star.io import XOutputStream
+    UNO_DISPONIBLE = True
+except ImportError:
+    UNO_DISPONIBLE = False
+
+# Segundos máximos esperando a que soffice acepte conexiones
+CONNECT_TIMEOUT = 30
+
+
+if UNO_DISPONIBLE:
+    class _OutputStream(unohelper.Base, XOutputStream):
+        """Recibe en memoria el PDF que exporta LibreOffice"""
+
+        def __init__(self):
+            self.buffer = io.BytesIO()
+
+        def writeBytes(self, data):
+            self.buffer.write(data.value)
+
+        def flush(self):
+            pass
+
+        def closeOutput(self):
+            pass
+
+
+def _prop(name: str, value):
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def _puerto_libre() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LibreOfficePool:
+    """Mantiene un soffice headless y convierte documentos a través de UNO"""
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._process = None
+        self._ctx = None
+        self._desktop = None
+        self._profile_dir = None
+        self._lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def start(self):
+        """Arranca soffice y se conecta, si no está ya corriendo"""
+        if self._pid != os.getpid():
+            # Proceso hijo (fork): la conexión heredada pertenece al padre
+            self._pid = os.getpid()
+            self._process = self._ctx = self._desktop = self._profile_dir = None
+
+        if self._desktop is not None and self._process.poll() is None:
+            return
+        self.stop()
+
+        # Puerto y perfil propios: varios procesos pueden tener su propio soffice
+        puerto = _puerto_libre()
+        self._profile_dir = tempfile.mkdtemp(prefix="gencer_lo_")
+        self._process = subprocess.Popen(
+            [
+                "soffice", "--headless", "--invisible", "--nologo", "--nodefault",
+                "--norestore", "--nolockcheck",
+                f"-env:UserInstallation={Path(self._profile_dir).as_uri()}",
+                f"--accept=socket,host=127.0.0.1,port={puerto};urp;",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_ctx
+        )
+        limite = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                self._ctx = resolver.resolve(
+                    f"uno:socket,host=127.0.0.1,port={puerto};urp;StarOffice.ComponentContext"
+                )
+                break
+            except NoConnectException:
+                if time.monotonic() > limite or self._process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("No se pudo conectar con LibreOffice")
+                time.sleep(0.25)
+
+        self._desktop = self._ctx.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", self._ctx
+        )
+        logger.info(f"LibreOffice iniciado en el puerto {puerto}")
+
+    def convert(self, docx_bytes: bytes) -> bytes:
+        """Convierte un DOCX en memoria a PDF sin pasar por disco"""
+        with self._lock:
+            self.start()
+
+            input_stream = self._ctx.ServiceManager.createInstanceWithArgumentsAndContext(
+                "com.sun.star.io.SequenceInputStream", (uno.ByteSequence(docx_bytes),), self._ctx
+            )
+            document = self._desktop.loadComponentFromURL(
+                "private:stream", "_blank", 0,
+                (_prop("InputStream", input_stream), _prop("Hidden", True))
+            )
+            try:
+                output = _OutputStream()
+                document.storeToURL(
+                    "private:stream",
+                    (_prop("FilterName", "writer_pdf_Export"), _prop("OutputStream", output))
+                )
+            finally:
+                document.close(True)
+
+            return output.buffer.getvalue()
+
+    def stop(self):
+        """Cierra LibreOffice y elimina su perfil temporal"""
+        if self._pid != os.getpid():
+            return
+
+        if self._desktop is not None:
+            try:
+                self._desktop.terminate()
+            except Exception:
+                pass
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+        if self._profile_dir:
+            shutil.rmtree(self._profile_dir, ignore_errors=True)
+
+        self._process = None
+        self._ctx = None
+        self._desktop = None
+        self._profile_dir = None
+
+
+def _convertir_con_soffice(docx_bytes: bytes) -> bytes:
+    """Conversión de respaldo: un soffice por documento"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        docx_path = os.path.join(tmp_dir, "certificado.docx")
+        with open(docx_path, "wb") as f:
+            f.write(docx_bytes)
+
+        subprocess.run(
+            [
+                "soffice",
+                "--headless",
+                # Perfil propio por llamada: soffice concurrentes con el perfil del
+                # usuario se bloquean entre sí o fallan
+                f"-env:UserInstallation={(Path(tmp_dir) / 'profile').as_uri()}",
+                "--convert-to", "pdf",
+                "--outdir", tmp_dir,
+                docx_path,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+
+        with open(os.path.join(tmp_dir, "certificado.pdf"), "rb") as f:
+            return f.read()
+
+
+_pool = LibreOfficePool() if UNO_DISPONIBLE else None
+
+
+def convert_docx_bytes_to_pdf_bytes(docx_bytes: bytes) -> bytes:
+    """Convierte un DOCX a PDF usando el LibreOffice persistente del proceso"""
+    if _pool is None:
+        return _convertir_con_soffice(docx_bytes)
+    return _pool.convert(docx_bytes)
+
+
+def detener_libreoffice():
+    """Cierra el LibreOffice persistente de este proceso, si se inició"""
+    if _pool is not None:
+        _pool.stop()
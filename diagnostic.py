@@ -2,25 +2,48 @@
 """
 diagnostico.py - Herramienta de diagnóstico para problemas de autenticación y permisos
 
-Uso: python diagnostic.py
+Uso: python diagnostic.py [--verbose]
 """
 
 import os
+import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
 from agents.datacampus_agent import DatacampusAgent
+from core.json_graph import json_loads
 from dotenv import load_dotenv
 load_dotenv()
-# Configurar logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+GRAPH_BASE_URL = 'https://graph.microsoft.com/v1.0'
+# URLs de las sondas; cambiar GRAPH_DRIVE basta para apuntar a un drive de SharePoint
+ME_URL = GRAPH_BASE_URL + '/me'
+GRAPH_DRIVE = ME_URL + '/drive'
+ROOT_CHILDREN_URL = GRAPH_DRIVE + '/root/children'
+ITEMS_URL = GRAPH_DRIVE + '/items/%s'
+ITEM_CONTENT_URL = ITEMS_URL + '/content'
+# Carpeta y sus primeros hijos en una sola petición; el total sale de folder.childCount
+FOLDER_PREVIEW_URL = ITEMS_URL + '?$expand=children($top=5;$select=name,folder)'
+# Segundos máximos por petición de diagnóstico
+REQUEST_TIMEOUT = 10
+
 class DiagnosticTool:
     def __init__(self):
         self.agent = DatacampusAgent()
+        # Una sola sesión: las sondas comparten conexiones TLS y reintentan 429/5xx
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=50,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        ))
+        self.session.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+        # Respuestas de las sondas lanzadas en paralelo: url -> Future
+        self._sondas: Dict[str, Future] = {}
         
     def ejecutar_diagnostico_completo(self):
         """Ejecuta un diagnóstico completo del sistema"""
@@ -34,6 +57,10 @@ class DiagnosticTool:
         if not self.verificar_autenticacion():
             return
         
+        # Las pruebas contra Graph son independientes: se lanzan todas a la vez
+        # y cada paso imprime su resultado en orden cuando lo necesita
+        self._lanzar_sondas()
+        
         # 3. Verificar permisos del token
         self.verificar_permisos_token()
         
@@ -45,6 +72,35 @@ class DiagnosticTool:
         
         print("\n✅ Diagnóstico completado. Revisa los resultados arriba.")
     
+    def _lanzar_sondas(self):
+        """Lanza en paralelo todas las peticiones GET del diagnóstico"""
+        urls = [
+            ME_URL,
+            GRAPH_DRIVE,
+            ROOT_CHILDREN_URL,
+        ]
+        excel_file_id = os.getenv('EXCEL_FILE_ID')
+        if excel_file_id:
+            urls += [
+                ITEMS_URL % excel_file_id,
+                ITEM_CONTENT_URL % excel_file_id,
+            ]
+        folder_id = os.getenv('CERTIFICADOS_FOLDER_ID', '01WIY7HEN2WE6VD2WDPFG3UMFYFXUVC25K')
+        urls += [
+            FOLDER_PREVIEW_URL % folder_id,
+        ]
+        
+        executor = ThreadPoolExecutor(max_workers=8)
+        self._sondas = {url: executor.submit(self.session.get, url, timeout=REQUEST_TIMEOUT) for url in urls}
+        executor.shutdown(wait=False)
+    
+    def _get(self, url: str) -> requests.Response:
+        """Respuesta de la sonda ya lanzada para url, o un GET si no se lanzó"""
+        sonda = self._sondas.pop(url, None)
+        if sonda is not None:
+            return sonda.result()
+        return self.session.get(url, timeout=REQUEST_TIMEOUT)
+    
     def verificar_variables_entorno(self):
         """Verifica que todas las variables de entorno estén configuradas"""
         print("\n1️⃣ VERIFICANDO VARIABLES DE ENTORNO...")
@@ -65,7 +121,8 @@ class DiagnosticTool:
         for var in variables_requeridas:
             valor = os.getenv(var)
             if valor:
-                print(f"   ✅ {var}: {'*' * min(len(valor), 20)}...")
+                print(f"   ✅ {var}: configurada")
+                logger.debug("%s configurada (%d caracteres)", var, len(valor))
             else:
                 print(f"   ❌ {var}: NO CONFIGURADA")
                 todas_ok = False
@@ -73,7 +130,8 @@ class DiagnosticTool:
         for var in variables_opcionales:
             valor = os.getenv(var)
             if valor:
-                print(f"   📋 {var}: {'*' * min(len(valor), 20)}...")
+                print(f"   📋 {var}: configurada")
+                logger.debug("%s configurada (%d caracteres)", var, len(valor))
             else:
                 print(f"   📋 {var}: usando valor por defecto")
         
@@ -94,7 +152,9 @@ class DiagnosticTool:
                 
                 # Verificar que el token sea válido
                 if hasattr(self.agent, 'token') and self.agent.token:
-                    print(f"   📋 Token obtenido (longitud: {len(self.agent.token)})")
+                    logger.debug("Token obtenido (longitud: %d)", len(self.agent.token))
+                    # El resto de pasos solo corre con token: el header se arma una vez
+                    self.session.headers['Authorization'] = f'Bearer {self.agent.token}'
                     return True
                 else:
                     print("   ❌ Token no disponible después de autenticación")
@@ -111,47 +171,39 @@ class DiagnosticTool:
         """Verifica los permisos del token haciendo llamadas de prueba"""
         print("\n3️⃣ VERIFICANDO PERMISOS DEL TOKEN...")
         
-        if not hasattr(self.agent, 'token') or not self.agent.token:
-            print("   ❌ No hay token disponible para verificar")
-            return
-        
-        headers = {
-            'Authorization': f'Bearer {self.agent.token}'
-        }
-        
         # Test 1: Información del usuario
         try:
-            response = requests.get('https://graph.microsoft.com/v1.0/me', headers=headers)
+            response = self._get(ME_URL)
             if response.status_code == 200:
-                user_info = response.json()
+                user_info = json_loads(response)
                 print(f"   ✅ Acceso a perfil de usuario: {user_info.get('displayName', 'N/A')}")
             else:
                 print(f"   ❌ Error al acceder perfil de usuario: {response.status_code}")
-                print(f"      Response: {response.text[:200]}...")
+                logger.debug("Response: %s...", response.content[:200].decode('utf-8', 'replace'))
         except Exception as e:
             print(f"   ❌ Excepción al verificar perfil: {str(e)}")
         
         # Test 2: Acceso a OneDrive
         try:
-            response = requests.get('https://graph.microsoft.com/v1.0/me/drive', headers=headers)
+            response = self._get(GRAPH_DRIVE)
             if response.status_code == 200:
-                drive_info = response.json()
+                drive_info = json_loads(response)
                 print(f"   ✅ Acceso a OneDrive: {drive_info.get('driveType', 'N/A')}")
             else:
                 print(f"   ❌ Error al acceder OneDrive: {response.status_code}")
-                print(f"      Response: {response.text[:200]}...")
+                logger.debug("Response: %s...", response.content[:200].decode('utf-8', 'replace'))
         except Exception as e:
             print(f"   ❌ Excepción al verificar OneDrive: {str(e)}")
         
         # Test 3: Listar archivos en raíz
         try:
-            response = requests.get('https://graph.microsoft.com/v1.0/me/drive/root/children', headers=headers)
+            response = self._get(ROOT_CHILDREN_URL)
             if response.status_code == 200:
-                items = response.json().get('value', [])
+                items = json_loads(response).get('value', [])
                 print(f"   ✅ Acceso a archivos raíz: {len(items)} elementos encontrados")
             else:
                 print(f"   ❌ Error al listar archivos raíz: {response.status_code}")
-                print(f"      Response: {response.text[:200]}...")
+                logger.debug("Response: %s...", response.content[:200].decode('utf-8', 'replace'))
         except Exception as e:
             print(f"   ❌ Excepción al listar archivos: {str(e)}")
     
@@ -166,21 +218,13 @@ class DiagnosticTool:
         
         print(f"   📋 Excel File ID: {excel_file_id[:30]}...")
         
-        if not hasattr(self.agent, 'token') or not self.agent.token:
-            print("   ❌ No hay token disponible")
-            return
-        
-        headers = {
-            'Authorization': f'Bearer {self.agent.token}'
-        }
-        
         # Test 1: Obtener información del archivo
         try:
-            url = f'https://graph.microsoft.com/v1.0/me/drive/items/{excel_file_id}'
-            response = requests.get(url, headers=headers)
+            url = ITEMS_URL % excel_file_id
+            response = self._get(url)
             
             if response.status_code == 200:
-                file_info = response.json()
+                file_info = json_loads(response)
                 print(f"   ✅ Archivo encontrado: {file_info.get('name', 'N/A')}")
                 print(f"   📋 Tamaño: {file_info.get('size', 'N/A')} bytes")
                 print(f"   📋 Última modificación: {file_info.get('lastModifiedDateTime', 'N/A')}")
@@ -206,15 +250,15 @@ class DiagnosticTool:
                 
             else:
                 print(f"   ❌ Error al acceder al archivo: {response.status_code}")
-                print(f"      Response: {response.text[:300]}...")
+                logger.debug("Response: %s...", response.content[:300].decode('utf-8', 'replace'))
                 
         except Exception as e:
             print(f"   ❌ Excepción al verificar archivo Excel: {str(e)}")
         
         # Test 2: Intentar descargar el contenido
         try:
-            url = f'https://graph.microsoft.com/v1.0/me/drive/items/{excel_file_id}/content'
-            response = requests.get(url, headers=headers)
+            url = ITEM_CONTENT_URL % excel_file_id
+            response = self._get(url)
             
             if response.status_code == 200:
                 content_length = len(response.content)
@@ -246,40 +290,28 @@ class DiagnosticTool:
         folder_id = os.getenv('CERTIFICADOS_FOLDER_ID', '01WIY7HEN2WE6VD2WDPFG3UMFYFXUVC25K')
         print(f"   📋 Carpeta ID: {folder_id}")
         
-        if not hasattr(self.agent, 'token') or not self.agent.token:
-            print("   ❌ No hay token disponible")
-            return
-        
-        headers = {
-            'Authorization': f'Bearer {self.agent.token}'
-        }
-        
         try:
-            url = f'https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}'
-            response = requests.get(url, headers=headers)
+            url = FOLDER_PREVIEW_URL % folder_id
+            response = self._get(url)
             
             if response.status_code == 200:
-                folder_info = response.json()
+                folder_info = json_loads(response)
                 print(f"   ✅ Carpeta encontrada: {folder_info.get('name', 'N/A')}")
                 
-                # Listar contenido de la carpeta
-                url_children = f'https://graph.microsoft.com/v1.0/me/drive/items/{folder_id}/children'
-                response_children = requests.get(url_children, headers=headers)
+                # Contenido de la carpeta: viene expandido en la misma respuesta
+                children = folder_info.get('children', [])
+                total = folder_info.get('folder', {}).get('childCount', len(children))
+                print(f"   📋 Elementos en la carpeta: {total}")
                 
-                if response_children.status_code == 200:
-                    children = response_children.json().get('value', [])
-                    print(f"   📋 Elementos en la carpeta: {len(children)}")
-                    
-                    # Mostrar algunos elementos
-                    for i, child in enumerate(children[:5]):
-                        item_type = "📁" if 'folder' in child else "📄"
-                        print(f"      {item_type} {child.get('name', 'N/A')}")
-                    
-                    if len(children) > 5:
-                        print(f"      ... y {len(children) - 5} elementos más")
-                        
-                else:
-                    print(f"   ⚠️  No se pudo listar contenido: {response_children.status_code}")
+                # Mostrar algunos elementos: OneDrive puede ignorar el $top dentro de $expand
+                # y devolver todos los hijos, así que la vista previa se recorta aquí
+                muestra = children[:5]
+                for child in muestra:
+                    item_type = "📁" if 'folder' in child else "📄"
+                    print(f"      {item_type} {child.get('name', 'N/A')}")
+                
+                if total > len(muestra):
+                    print(f"      ... y {total - len(muestra)} elementos más")
                     
             else:
                 print(f"   ❌ Error al acceder carpeta: {response.status_code}")
@@ -318,6 +350,13 @@ class DiagnosticTool:
 
 
 def main():
+    # Por defecto solo el informe; --verbose añade el detalle de cada respuesta
+    verbose = '--verbose' in sys.argv or '-v' in sys.argv
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    
     print("🚀 Iniciando diagnóstico del sistema...")
     
     diagnostic = DiagnosticTool()
@@ -5,29 +5,63 @@ main_cli.py - Interfaz de línea de comandos para generar certificados
 Uso:
     python main_cli.py                    # Ejecutar flujo completo
     python main_cli.py --verbose         # Modo verboso
+    python main_cli.py --no-cache        # Ignorar la caché del Excel
     python main_cli.py --help            # Mostrar ayuda
 """
 
 import argparse
+import atexit
 import logging
+import os
+import queue
 import sys
-from pathlib import Path
-from config import CertificadosConfig
-from tests.test_e2e import CertificadosProcessor
+from logging.handlers import QueueHandler, QueueListener
+from typing import TYPE_CHECKING
+
+# config y el procesador (pandas, docxtpl, ...) se importan dentro de main(),
+# después de argparse: --help no paga esas importaciones
+if TYPE_CHECKING:
+    from config import CertificadosConfig
 
 def setup_logging(verbose: bool = False, log_file: str = None):
-    """Configura el sistema de logging"""
+    """
+    Configura el sistema de logging
+
+    Los hilos de subida solo encolan los registros; la escritura en consola y en
+    el archivo la hace un hilo aparte (QueueListener), fuera del camino de subida.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        # Ya configurado (p. ej. por main() antes de importar el procesador)
+        return
+
     level = logging.DEBUG if verbose else logging.INFO
-    
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
     handlers = [logging.StreamHandler(sys.stdout)]
     if log_file:
         handlers.append(logging.FileHandler(log_file))
-    
-    logging.basicConfig(
-        level=level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=handlers
-    )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    cola = queue.SimpleQueue()
+    queue_handler = QueueHandler(cola)
+    # El mensaje se formatea una sola vez, en los handlers del listener
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(cola, *handlers, respect_handler_level=True)
+
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    if hasattr(os, 'register_at_fork'):
+        def _log_directo_en_hijo():
+            # Los workers creados con fork no tienen el hilo del listener: escriben directo
+            root.removeHandler(queue_handler)
+            for handler in handlers:
+                root.addHandler(handler)
+        os.register_at_fork(after_in_child=_log_directo_en_hijo)
 
 def verificar_requisitos():
     """Verifica que todos los archivos necesarios estén presentes"""
@@ -36,7 +70,9 @@ def verificar_requisitos():
         'plantilla.docx'
     ]
     
-    faltantes = [archivo for archivo in archivos_requeridos if not Path(archivo).exists()]
+    # Un solo listado del directorio en lugar de un stat por archivo
+    existentes = {entry.name for entry in os.scandir('.')}
+    faltantes = [archivo for archivo in archivos_requeridos if archivo not in existentes]
     
     if faltantes:
         print(" Archivos requeridos no encontrados:")
@@ -51,13 +87,12 @@ def verificar_requisitos():
     
     return True
 
-def mostrar_info_configuracion(config: CertificadosConfig):
+def mostrar_info_configuracion(config: 'CertificadosConfig'):
     """Muestra información de la configuración actual"""
     print("\n Configuración actual:")
     print(f"    Carpeta Certificados ID: {config.certificados_folder_id}")
     print(f"    Excel File ID: {config.excel_file_id[:20]}...")
     print(f"    Plantilla: {config.plantilla_path}")
-    print(f"    Carpeta temporal: {config.temp_folder}")
     print(f"    Columna certificado: {config.columna_certificado}")
     print(f"    Columna empresa: {config.columna_empresa}")
 
@@ -92,6 +127,12 @@ Ejemplos:
         help='Mostrar configuración actual y salir'
     )
     
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Descargar y parsear el Excel aunque no haya cambiado desde la última ejecución'
+    )
+    
     parser.add_argument(
         '--log-file',
         help='Archivo donde guardar los logs (por defecto: certificados_log.log)'
@@ -104,6 +145,8 @@ Ejemplos:
         return 1
     
     try:
+        from config import CertificadosConfig
+
         # Cargar configuración
         config = CertificadosConfig.from_env()
         
@@ -123,7 +166,8 @@ Ejemplos:
         mostrar_info_configuracion(config)
         
         # Crear procesador
-        processor = CertificadosProcessor()
+        from tests.test_e2e import CertificadosProcessor
+        processor = CertificadosProcessor(use_cache=not args.no_cache, render_backend=config.render_backend)
         
         if args.dry_run:
             print("\n MODO SIMULACIÓN - No se generarán archivos reales")
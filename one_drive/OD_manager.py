@@ -1,17 +1,27 @@
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import msal
 import os
+import random
+import threading
+import time
 import dotenv
+import email.utils
 import webbrowser
 import io
 import json
 from msal import PublicClientApplication, SerializableTokenCache
 from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+from typing import BinaryIO, Dict, List, Optional, Tuple
+from urllib.parse import quote
 from dataclasses import dataclass
 from auth.auth_manager import AuthManager
+from config import EXCEL_READ_ENGINE
+from core.json_graph import json_dumps, json_loads
 
 # Inicializar y autenticar
 dotenv.load_dotenv()
@@ -24,6 +34,29 @@ SCOPES = [
     'https://graph.microsoft.com/Sites.ReadWrite.All',
     'https://graph.microsoft.com/User.Read'
 ]
+# Máximo de sub-peticiones por llamada a /$batch en Microsoft Graph
+GRAPH_BATCH_LIMIT = 20
+# Conexiones keep-alive hacia Graph compartidas por todas las subidas concurrentes
+GRAPH_MAX_CONNECTIONS = 32
+# Por encima de 4 MiB Graph exige sesión de carga; los fragmentos deben ser múltiplos de 320 KiB
+SIMPLE_UPLOAD_LIMIT = 4 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 16 * 320 * 1024
+# Reintentos de POST ante throttling de Graph (429/503)
+MAX_RETRIES = 5
+# Segundos antes de la expiración en los que el token ya se renueva
+TOKEN_REFRESH_MARGIN = 60
+
+def _retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Segundos indicados por Retry-After (número o fecha HTTP); None si falta o no se entiende"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
 
 @dataclass
 class DriveItem:
@@ -40,10 +73,28 @@ class OneDriveManager:
         """Inicializar OneDriveManager con o sin token"""
         self.token = token
         self.authenticated = token is not None
+        self._auth = None
+        self._token_expires_at = 0.0
+        # Las subidas concurrentes comparten el token: solo un hilo lo renueva
+        self._token_lock = threading.RLock()
         
         # Inicializar atributos que se usan en initialize_datacampus
         self.datacampus_drive_id = None
         self.datacampus_root_id = None
+
+        # Sesión compartida: reutiliza conexiones TLS entre peticiones y entre hilos
+        self.session = requests.Session()
+        # Respuestas JSON comprimidas: los listados de carpetas viajan con gzip
+        self.session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate"})
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=GRAPH_MAX_CONNECTIONS,
+            pool_maxsize=GRAPH_MAX_CONNECTIONS,
+            pool_block=True,
+            # Solo métodos idempotentes: un POST no se repite a ciegas
+            # con jitter para que las subidas en paralelo no reintenten a la vez
+            max_retries=Retry(total=3, backoff_factor=0.3, backoff_jitter=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                              raise_on_status=False)
+        ))
         
         if token:
             self._initialize_with_token(token)
@@ -52,35 +103,71 @@ class OneDriveManager:
         """Inicialización con token válido"""
         self.token = token
         self.authenticated = True
+        expires_in = token.get('expires_in', 3600) if isinstance(token, dict) else 3600
+        self._token_expires_at = time.monotonic() + expires_in - TOKEN_REFRESH_MARGIN
 
-    def authenticate(self):
+    def authenticate(self, force_refresh: bool = False):
         """Método para autenticar después de la inicialización"""
-        if not self.token:
-            # Obtener token usando AuthManager
-            auth = AuthManager()
-            self.token = auth.get_token()
-            self.authenticated = True
+        with self._token_lock:
+            if not self.token or force_refresh:
+                # Obtener token usando AuthManager (reutilizado: la caché MSAL ya está cargada)
+                if self._auth is None:
+                    self._auth = AuthManager()
+                self._initialize_with_token(self._auth.get_token(force_refresh=force_refresh))
         return True
 
-    def _make_request(self, method: str, url: str, **kwargs) -> requests.Response:
-        """Realizar petición HTTP con manejo de errores"""
+    def _refresh_token(self, previous_token) -> None:
+        """Renueva el token salvo que otro hilo ya lo haya hecho mientras se esperaba el lock"""
+        with self._token_lock:
+            if self.token is previous_token:
+                self.authenticate(force_refresh=True)
+
+    def get_token(self) -> str:
+        """Access token vigente; solo se renueva cuando está por expirar"""
         if not self.token:
             raise Exception("No hay token de autenticación. Llama a authenticate() primero.")
-            
+        if time.monotonic() >= self._token_expires_at:
+            with self._token_lock:
+                # Otro hilo pudo renovarlo mientras se esperaba el lock
+                if time.monotonic() >= self._token_expires_at:
+                    print(" Token por expirar, renovando...")
+                    self.authenticate(force_refresh=True)
+        return self.token['access_token']
+
+    def _make_request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Realizar petición HTTP con manejo de errores"""
         headers = kwargs.get('headers', {})
-        headers['Authorization'] = f"Bearer {self.token['access_token']}"
+        headers['Authorization'] = f"Bearer {self.get_token()}"
         kwargs['headers'] = headers
+        token = self.token
         
-        response = requests.request(method, url, **kwargs)
+        response = self._send(method, url, **kwargs)
         
         if response.status_code == 401:
             print(" Token expirado, reautenticando...")
-            self.authenticate()
+            self._refresh_token(token)
             headers['Authorization'] = f"Bearer {self.token['access_token']}"
-            response = requests.request(method, url, **kwargs)
+            response = self._send(method, url, **kwargs)
             
         return response
 
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Enviar la petición reintentando los POST que Graph rechazó por throttling"""
+        # GET/PUT/DELETE ya los reintenta el Retry del adapter; un POST solo se repite
+        # ante 429/503, cuando Graph no lo ejecutó, respetando Retry-After
+        for attempt in range(MAX_RETRIES):
+            response = self.session.request(method, url, **kwargs)
+            if method.upper() != 'POST' or response.status_code not in (429, 503):
+                return response
+
+            wait = _retry_after_seconds(response.headers.get('Retry-After'))
+            if wait is None:
+                wait = round(random.uniform(0, 2 ** attempt), 2)
+            print(f" Graph respondió {response.status_code}, reintentando en {wait}s...")
+            time.sleep(wait)
+
+        return response
+
     def initialize_datacampus(self) -> Tuple[str, str]:
         """Inicializar y encontrar la carpeta datacampus"""
         if self.datacampus_drive_id and self.datacampus_root_id:
@@ -92,7 +179,7 @@ class OneDriveManager:
         if response.status_code != 200:
             raise Exception(f"Error al obtener archivos compartidos: {response.status_code} - {response.text}")
 
-        shared_items = response.json().get('value', [])
+        shared_items = json_loads(response).get('value', [])
         
         for item in shared_items:
             if item['name'].lower() == "datacampus":
@@ -120,7 +207,7 @@ class OneDriveManager:
             raise Exception(f"Error al listar contenido: {response.status_code} - {response.text}")
 
         items = []
-        for item_data in response.json().get('value', []):
+        for item_data in json_loads(response).get('value', []):
             item_type = 'folder' if 'folder' in item_data else 'file'
             
             items.append(DriveItem(
@@ -161,7 +248,7 @@ class OneDriveManager:
         data.to_excel(excel_buffer, index=False, engine='openpyxl')
         excel_buffer.seek(0)
 
-        url = f"https://graph.microsoft.com/v1.0/drives/{self.datacampus_drive_id}/items/{folder_id}:/{filename}:/content"
+        url = f"https://graph.microsoft.com/v1.0/drives/{self.datacampus_drive_id}/items/{folder_id}:/{quote(filename)}:/content"
         headers = {
             "Content-Type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         }
@@ -170,7 +257,7 @@ class OneDriveManager:
 
         if response.status_code in [200, 201]:
             print(f" Archivo '{filename}' creado exitosamente")
-            return response.json()
+            return json_loads(response)
         else:
             raise Exception(f"Error al crear archivo: {response.status_code} - {response.text}")
 
@@ -189,7 +276,7 @@ class OneDriveManager:
             raise Exception(f"Error al descargar archivo: {response.status_code} - {response.text}")
 
         try:
-            df = pd.read_excel(io.BytesIO(response.content), engine='openpyxl')
+            df = pd.read_excel(io.BytesIO(response.content), engine=EXCEL_READ_ENGINE)
             print(" DEBUG: Excel leído correctamente. Shape:", df.shape)
             return df
         except Exception as e:
@@ -215,7 +302,7 @@ class OneDriveManager:
 
         if response.status_code == 200:
             print(" Archivo actualizado exitosamente")
-            return response.json()
+            return json_loads(response)
         else:
             raise Exception(f"Error al actualizar archivo: {response.status_code} - {response.text}")
 
@@ -239,21 +326,125 @@ class OneDriveManager:
             "@microsoft.graph.conflictBehavior": "rename"
         }
         
-        response = self._make_request('POST', url, json=data)
+        response = self._make_request('POST', url, data=json_dumps(data), headers={'Content-Type': 'application/json'})
 
         if response.status_code == 201:
             print(f" Carpeta '{folder_name}' creada exitosamente")
-            return response.json()
+            return json_loads(response)
         else:
             raise Exception(f"Error al crear carpeta: {response.status_code} - {response.text}")
 
+    def create_folders_batch(self, parent_folder_id: str, names: List[str]) -> Dict[str, str]:
+        """Crear varias carpetas con /$batch: una petición por cada 20 carpetas"""
+        url = "https://graph.microsoft.com/v1.0/$batch"
+        children_url = f"/drives/{self.datacampus_drive_id}/items/{parent_folder_id}/children"
+        folders = {}
+
+        for start in range(0, len(names), GRAPH_BATCH_LIMIT):
+            chunk = names[start:start + GRAPH_BATCH_LIMIT]
+            batch = {
+                "requests": [
+                    {
+                        "id": str(i),
+                        "method": "POST",
+                        "url": children_url,
+                        "body": {
+                            "name": name,
+                            "folder": {},
+                            "@microsoft.graph.conflictBehavior": "rename"
+                        },
+                        "headers": {"Content-Type": "application/json"}
+                    }
+                    for i, name in enumerate(chunk)
+                ]
+            }
+
+            response = self._make_request('POST', url, data=json_dumps(batch), headers={'Content-Type': 'application/json'})
+            if response.status_code != 200:
+                raise Exception(f"Error al crear carpetas: {response.status_code} - {response.text}")
+
+            for sub_response in json_loads(response).get('responses', []):
+                name = chunk[int(sub_response['id'])]
+                if sub_response.get('status') == 201:
+                    folders[name] = sub_response['body']['id']
+                    print(f" Carpeta '{name}' creada exitosamente")
+                else:
+                    print(f" Error al crear carpeta '{name}': {sub_response.get('status')} - {sub_response.get('body')}")
+
+        return folders
+
+    def upload_file(self, folder_id: str, filename: str, content: bytes,
+                    content_type: str = "application/octet-stream") -> Dict:
+        """Subir un archivo a una carpeta"""
+        if len(content) > SIMPLE_UPLOAD_LIMIT:
+            return self._upload_with_session(folder_id, filename, io.BytesIO(content), len(content))
+
+        url = f"https://graph.microsoft.com/v1.0/drives/{self.datacampus_drive_id}/items/{folder_id}:/{quote(filename)}:/content"
+        headers = {"Content-Type": content_type}
+
+        response = self._make_request('PUT', url, headers=headers, data=content)
+
+        if response.status_code in [200, 201]:
+            print(f" Archivo '{filename}' subido exitosamente")
+            return json_loads(response)
+        else:
+            raise Exception(f"Error al subir archivo: {response.status_code} - {response.text}")
+
+    def _upload_with_session(self, folder_id: str, filename: str, stream: BinaryIO, size: int) -> Dict:
+        """Subir por sesión de carga: fragmentos en orden, solo uno en memoria a la vez"""
+        url = f"https://graph.microsoft.com/v1.0/drives/{self.datacampus_drive_id}/items/{folder_id}:/{quote(filename)}:/createUploadSession"
+        response = self._make_request(
+            'POST', url,
+            data=json_dumps({"item": {"@microsoft.graph.conflictBehavior": "replace"}}),
+            headers={'Content-Type': 'application/json'}
+        )
+
+        if response.status_code != 200:
+            raise Exception(f"Error al crear sesión de carga: {response.status_code} - {response.text}")
+
+        # La uploadUrl ya viene autenticada: se envía sin el header Authorization
+        upload_url = json_loads(response)['uploadUrl']
+        start = 0
+        while start < size:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                raise Exception(f"El archivo '{filename}' terminó antes de lo esperado ({start} de {size} bytes)")
+            end = start + len(chunk) - 1
+            response = self.session.put(upload_url, data=chunk, headers={
+                "Content-Length": str(len(chunk)),
+                "Content-Range": f"bytes {start}-{end}/{size}"
+            })
+            if response.status_code not in [200, 201, 202]:
+                raise Exception(f"Error al subir fragmento: {response.status_code} - {response.text}")
+            start = end + 1
+
+        print(f" Archivo '{filename}' subido exitosamente")
+        return json_loads(response)
+
+    def upload_files(self, folder_id: str, files: List[Tuple[str, bytes]]) -> List[Optional[Dict]]:
+        """Subir varios archivos en paralelo sobre la sesión compartida (None si falla)"""
+        def _upload(item: Tuple[str, bytes]) -> Optional[Dict]:
+            filename, content = item
+            try:
+                return self.upload_file(folder_id, filename, content)
+            except Exception as e:
+                print(f" {e}")
+                return None
+
+        if not files:
+            return []
+
+        # Nunca más hilos que conexiones: el resto esperaría en el pool sin ganar nada
+        with ThreadPoolExecutor(max_workers=min(GRAPH_MAX_CONNECTIONS, len(files))) as executor:
+            return list(executor.map(_upload, files))
+
     def get_item_info(self, item_id: str) -> Dict:
         """Obtener información detallada de un elemento"""
         url = f"https://graph.microsoft.com/v1.0/drives/{self.datacampus_drive_id}/items/{item_id}"
         response = self._make_request('GET', url)
 
         if response.status_code == 200:
-            return response.json()
+            return json_loads(response)
         else:
             raise Exception(f"Error al obtener información: {response.status_code} - {response.text}")
 
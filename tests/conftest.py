@@ -0,0 +1,17 @@
+import logging
+import os
+import sys
+from pathlib import Path
+
+# Sin LibreOffice ni Word: los "PDF" son el DOCX renderizado. Debe fijarse antes de
+# importar core.certificados, que lo lee al cargarse
+os.environ["PDF_BACKEND"] = "simulado"
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+# plantilla.docx y samples/ se abren con rutas relativas a la raíz del proyecto
+os.chdir(ROOT)
+
+# El procesador configura el logging (consola + certificados_log.log) al importarse si
+# nadie lo hizo antes: en los tests los registros quedan en la captura de pytest
+logging.getLogger().addHandler(logging.NullHandler())
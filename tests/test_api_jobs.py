@@ -0,0 +1,92 @@
+import io
+import time
+import zipfile
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import api_server
+
+DATOS_PERSONA = "samples/datos_persona.xlsx"
+
+
+@pytest.fixture
+def client():
+    api_server.certificados_jobs.clear()
+    # Las tareas en segundo plano solo avanzan dentro del contexto del cliente
+    with TestClient(api_server.app) as client:
+        yield client
+    api_server.certificados_jobs.clear()
+
+
+def _crear_job(client):
+    with open(DATOS_PERSONA, "rb") as f:
+        response = client.post(
+            "/certificados/jobs",
+            files={"excel_file": ("datos_persona.xlsx", f, "application/octet-stream")},
+        )
+    assert response.status_code == 200
+    return response.json()
+
+
+def _esperar(client, status_url, timeout=30):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        estado = client.get(status_url).json()
+        if estado["state"] in ("finished", "failed"):
+            return estado
+        time.sleep(0.1)
+    raise AssertionError("el trabajo no terminó a tiempo")
+
+
+def test_job_genera_zip_por_compania(client):
+    job = _crear_job(client)
+
+    estado = _esperar(client, job["status_url"])
+
+    assert estado["state"] == "finished"
+    assert estado["total_certificados"] == 3
+    response = client.get(estado["result_zip_url"])
+    assert response.status_code == 200
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
+        nombres = zf.namelist()
+    datos = pd.read_excel(DATOS_PERSONA, dtype=str, na_filter=False)
+    pendientes = datos[datos["certificado"] == "no"]
+    assert sorted(nombres) == sorted(
+        f"{fila['compañia']}/certificado_{fila['nombre'].replace(' ', '_')}.pdf"
+        for _, fila in pendientes.iterrows()
+    )
+
+
+def test_resultado_de_job_sin_terminar_responde_409(client):
+    api_server.certificados_jobs["pendiente"] = {
+        "state": "running", "result": None, "total_certificados": None, "error": None, "finished_at": None
+    }
+
+    assert client.get("/certificados/jobs/pendiente/result").status_code == 409
+    assert client.get("/certificados/jobs/no-existe/result").status_code == 404
+
+
+def test_jobs_terminados_se_descartan_tras_el_ttl(client, monkeypatch):
+    monkeypatch.setattr(api_server, "CERTIFICADOS_JOB_TTL", 60)
+    base = {"state": "finished", "result": b"zip", "total_certificados": 1, "error": None}
+    api_server.certificados_jobs["vencido"] = dict(base, finished_at=time.monotonic() - 61)
+    api_server.certificados_jobs["reciente"] = dict(base, finished_at=time.monotonic())
+
+    assert client.get("/status/vencido").status_code == 404
+    assert client.get("/status/reciente").json()["state"] == "finished"
+    assert "vencido" not in api_server.certificados_jobs
+
+
+def test_contenido_de_archivo_con_columnas_numericas(client, monkeypatch):
+    class ManagerFalso:
+        def read_excel_file(self, file_id):
+            return pd.DataFrame([["Ana", 1]], columns=[0, 1])
+
+    monkeypatch.setattr(api_server, "od_manager", ManagerFalso())
+
+    response = client.get("/files/excel-id/content")
+
+    assert response.status_code == 200
+    assert response.json()["data"] == [{"0": "Ana", "1": "1"}]
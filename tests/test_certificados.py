@@ -0,0 +1,88 @@
+import asyncio
+
+import pandas as pd
+import pytest
+
+import core.certificados as certificados
+from core.certificados import filas_pendientes, generar_certificados_desde_excel
+
+DATOS_PERSONA = "samples/datos_persona.xlsx"
+
+
+def _generar(excel_input, al_completar_compania=None):
+    return asyncio.run(generar_certificados_desde_excel(excel_input, al_completar_compania))
+
+
+def test_marca_las_filas_pendientes_y_conserva_columnas():
+    original = pd.read_excel(DATOS_PERSONA)
+    pendientes = original.index[original["certificado"] == "no"].tolist()
+
+    certificados_por_compania, df = _generar(DATOS_PERSONA)
+
+    # Se devuelve la hoja completa (p. ej. "plantilla"), no solo las columnas del render
+    assert list(df.columns) == list(original.columns)
+    assert (df["certificado"] == "si").all()
+
+    generados = [item for archivos in certificados_por_compania.values() for item in archivos]
+    assert sorted(item["fila"] for item in generados) == pendientes
+    for item in generados:
+        assert item["filename"] == "certificado_" + original.at[item["fila"], "nombre"].replace(" ", "_") + ".pdf"
+        assert item["content"]
+
+
+def test_avisa_cada_compania_al_completarse():
+    llamadas = []
+    certificados_por_compania, _ = _generar(
+        DATOS_PERSONA, lambda compania, archivos: llamadas.append((compania, archivos))
+    )
+
+    assert sorted(compania for compania, _ in llamadas) == sorted(certificados_por_compania)
+    for compania, archivos in llamadas:
+        assert [a["filename"] for a in archivos] == [a["filename"] for a in certificados_por_compania[compania]]
+
+
+def test_sin_pendientes_no_genera_nada():
+    df = pd.DataFrame({"nombre": ["Ana"], "cedula": ["1"], "compañia": ["X"], "certificado": ["si"]})
+
+    certificados_por_compania, df_actualizado = _generar(df)
+
+    assert certificados_por_compania == {}
+    assert df_actualizado["certificado"].tolist() == ["si"]
+
+
+def test_pendientes_sin_distinguir_mayusculas():
+    df = pd.DataFrame({"certificado": ["No", "si", "NO", ""]})
+
+    assert filas_pendientes(df).tolist() == [True, False, True, False]
+
+
+def test_si_fallan_todas_las_filas_lanza_error_y_no_marca(monkeypatch):
+    # Plantilla inválida: el render falla en cada fila, como sin soffice en el PATH
+    monkeypatch.setattr(certificados, "_plantilla_bytes", lambda path=None: b"no es un docx")
+    df = pd.read_excel(DATOS_PERSONA)
+
+    with pytest.raises(RuntimeError):
+        _generar(df)
+
+    assert filas_pendientes(df).sum() == 3
+
+
+def test_fondo_reportlab_no_se_genera_sin_conversor_real(tmp_path):
+    # PDF_BACKEND=simulado (conftest): el "PDF" sería el DOCX, no debe quedar en caché
+    fondo = tmp_path / "plantilla.pdf"
+
+    with pytest.raises(RuntimeError):
+        certificados._generar_fondo_pdf(str(fondo))
+
+    assert not fondo.exists()
+
+
+def test_fondo_reportlab_descarta_conversiones_que_no_son_pdf(tmp_path, monkeypatch):
+    monkeypatch.setattr(certificados, "PDF_BACKEND", "libreoffice")
+    monkeypatch.setattr(certificados, "convert_docx_bytes_to_pdf_bytes", lambda docx_bytes: docx_bytes)
+    fondo = tmp_path / "plantilla.pdf"
+
+    with pytest.raises(RuntimeError):
+        certificados._generar_fondo_pdf(str(fondo))
+
+    assert not fondo.exists()
@@ -0,0 +1,157 @@
+import email.utils
+import json
+import time
+from urllib.parse import unquote
+
+import pytest
+
+import agents.datacampus_agent as datacampus_agent
+from agents.datacampus_agent import DatacampusAgent, _espera_reintento
+
+
+class Respuesta:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.content = json.dumps(body or {}).encode()
+        self.text = self.content.decode()
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+
+class GraphFalso:
+    """
+    Responde los $batch de carpetas: las de `existentes` se encuentran, las de
+    `fallan` responden 500 y las de `limitadas` responden 429 la primera vez
+    """
+
+    def __init__(self, existentes=(), fallan=(), limitadas=()):
+        self.existentes = set(existentes)
+        self.fallan = set(fallan)
+        self.limitadas = set(limitadas)
+        self.buscadas = []
+        self.creadas = []
+
+    def request(self, method, url, **kwargs):
+        assert method == "POST" and url.endswith("/$batch")
+        respuestas = []
+        for sub in json.loads(kwargs["data"])["requests"]:
+            if sub["method"] == "GET":
+                nombre = unquote(sub["url"].split("$filter=")[1])[len("name eq '"):-1]
+                self.buscadas.append(nombre)
+                if nombre in self.limitadas:
+                    self.limitadas.discard(nombre)
+                    respuestas.append({"id": sub["id"], "status": 429, "headers": {"Retry-After": "0"}})
+                elif nombre in self.fallan:
+                    respuestas.append({"id": sub["id"], "status": 500, "body": {}})
+                else:
+                    value = [{"id": f"id-{nombre}", "name": nombre, "folder": {}}] if nombre in self.existentes else []
+                    respuestas.append({"id": sub["id"], "status": 200, "body": {"value": value}})
+            else:
+                nombre = sub["body"]["name"]
+                self.creadas.append(nombre)
+                respuestas.append({"id": sub["id"], "status": 201, "body": {"id": f"nueva-{nombre}"}})
+        return Respuesta(200, {"responses": respuestas})
+
+
+@pytest.fixture
+def agent():
+    agent = DatacampusAgent()
+    yield agent
+    agent.close()
+
+
+def test_crear_carpetas_bulk_busca_y_crea_solo_las_que_faltan(agent):
+    graph = GraphFalso(existentes={"Empresa A"})
+    agent.graph_session.request = graph.request
+
+    carpetas = agent.crear_carpetas_bulk(["Empresa A", "Empresa B", "Empresa A"], parent_id="raiz")
+
+    assert carpetas == {"Empresa A": "id-Empresa A", "Empresa B": "nueva-Empresa B"}
+    assert graph.creadas == ["Empresa B"]
+
+    # Segunda llamada: todo sale de la caché, sin peticiones a Graph
+    graph.buscadas.clear()
+    assert agent.crear_carpetas_bulk(["Empresa A", "Empresa B"], parent_id="raiz") == carpetas
+    assert graph.buscadas == []
+
+
+def test_crear_carpetas_bulk_no_crea_si_la_busqueda_fallo(agent):
+    # Crear con conflictBehavior=rename una carpeta que quizá existe la duplicaría
+    graph = GraphFalso(existentes={"Empresa A"}, fallan={"Empresa A"})
+    agent.graph_session.request = graph.request
+
+    carpetas = agent.crear_carpetas_bulk(["Empresa A", "Empresa B"], parent_id="raiz")
+
+    assert carpetas == {"Empresa B": "nueva-Empresa B"}
+    assert graph.creadas == ["Empresa B"]
+
+
+def test_crear_carpetas_bulk_reintenta_busquedas_limitadas(agent):
+    graph = GraphFalso(existentes={"Empresa A"}, limitadas={"Empresa A", "Empresa B"})
+    agent.graph_session.request = graph.request
+
+    carpetas = agent.crear_carpetas_bulk(["Empresa A", "Empresa B"], parent_id="raiz")
+
+    assert carpetas == {"Empresa A": "id-Empresa A", "Empresa B": "nueva-Empresa B"}
+    assert sorted(graph.buscadas) == ["Empresa A", "Empresa A", "Empresa B", "Empresa B"]
+    assert graph.creadas == ["Empresa B"]
+
+
+def test_subir_con_sesion_envia_fragmentos_en_orden(agent, monkeypatch):
+    monkeypatch.setattr(datacampus_agent, "UPLOAD_CHUNK_SIZE", 320 * 1024)
+    content = bytes(range(256)) * 3000  # ~750 KiB: tres fragmentos, el último incompleto
+    fragmentos = []
+
+    def request(method, url, **kwargs):
+        assert method == "POST" and url.endswith(":/certificado%201.pdf:/createUploadSession")
+        return Respuesta(200, {"uploadUrl": "https://upload.example/sesion"})
+
+    def put(url, headers=None, data=None):
+        assert url == "https://upload.example/sesion"
+        # La uploadUrl ya viene autenticada: no debe viajar el token
+        assert headers["Authorization"] is None
+        fragmentos.append((headers["Content-Range"], bytes(data)))
+        return Respuesta(202)
+
+    agent.graph_session.request = request
+    agent.graph_session.put = put
+
+    assert agent._subir_con_sesion("carpeta", "certificado 1.pdf", content)
+
+    total = len(content)
+    assert [rango for rango, _ in fragmentos] == [
+        f"bytes 0-327679/{total}",
+        f"bytes 327680-655359/{total}",
+        f"bytes 655360-{total - 1}/{total}",
+    ]
+    assert b"".join(datos for _, datos in fragmentos) == content
+
+
+def test_subir_con_sesion_falla_si_un_fragmento_falla(agent, monkeypatch):
+    monkeypatch.setattr(datacampus_agent, "UPLOAD_CHUNK_SIZE", 320 * 1024)
+    enviados = []
+
+    def put(url, headers=None, data=None):
+        enviados.append(headers["Content-Range"])
+        return Respuesta(500 if len(enviados) == 2 else 202)
+
+    agent.graph_session.request = lambda method, url, **kwargs: Respuesta(200, {"uploadUrl": "https://upload.example/s"})
+    agent.graph_session.put = put
+
+    assert not agent._subir_con_sesion(None, "grande.pdf", b"x" * (1024 * 1024))
+    # Tras el fragmento fallido no se siguen enviando los demás
+    assert len(enviados) == 2
+
+
+def test_espera_reintento_acepta_fecha_http():
+    fecha = email.utils.formatdate(time.time() + 10, usegmt=True)
+
+    assert 0 < _espera_reintento(fecha, 0) <= 10
+    assert _espera_reintento("3", 0) == 3
+    # Valor ilegible: backoff exponencial del intento
+    assert 0 <= _espera_reintento("pronto", 2) <= 2
@@ -1,35 +1,60 @@
+import asyncio
 import os
 import io
+import re
+import hashlib
+import json
 import logging
+import threading
+import time
 import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Any, Optional, Tuple, Union
 
 import pandas as pd
 
-from agents.datacampus_agent import DatacampusAgent
-from core.certificados import generar_certificados_desde_excel  # async: devuelve (certificados_por_compania, df_actualizado)
+from agents.datacampus_agent import DatacampusAgent, dataframe_a_xlsx
+from config import CertificadosConfig
+from main_cli import setup_logging
+from core.certificados import filas_pendientes, generar_certificados_desde_excel  # async: devuelve (certificados_por_compania, df_actualizado)
 
 
 # ==============================================================
 # Config de logging
 # ==============================================================
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('certificados_log.log'),
-        logging.StreamHandler()
-    ]
-)
+# Escritura de logs en un hilo aparte (QueueListener): no bloquea los hilos de subida.
+# Si main_cli ya configuró el logging, esto no hace nada
+setup_logging(log_file='certificados_log.log')
 logger = logging.getLogger(__name__)
 
+# Cachés entre ejecuciones, fuera del repositorio (GENCER_CACHE_DIR para cambiar la ubicación)
+CACHE_DIR = Path(os.getenv("GENCER_CACHE_DIR") or Path.home() / ".cache" / "gencer")
+# Excel ya parseados, por (file_id, eTag): si el archivo no cambió no se vuelve a descargar
+EXCEL_CACHE_DIR = CACHE_DIR / "excel"
+# IDs de las carpetas de empresa entre ejecuciones; pasado el TTL se vuelven a consultar
+FOLDER_CACHE_PATH = CACHE_DIR / "carpetas.json"
+FOLDER_CACHE_TTL = int(os.getenv("FOLDER_CACHE_TTL", str(7 * 24 * 3600)))
+# Subidas simultáneas a OneDrive: la subida de archivos pequeños depende de la latencia
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+# Compañías subiéndose a la vez mientras se generan las demás (cada una ya sube sus PDFs en paralelo)
+EMPRESAS_EN_PARALELO = 4
+# Caracteres no permitidos en nombres de carpeta: todo salvo alfanuméricos (incluye tildes y ñ), espacio, '-' y '_'
+_NO_PERMITIDOS_CARPETA = re.compile(r"[^\w \-]")
+
 
 class CertificadosProcessor:
  
 
-    def __init__(self):
-        self.agent = DatacampusAgent()
+    def __init__(self, use_cache: bool = True, render_backend: Optional[str] = None,
+                 agent: Optional[DatacampusAgent] = None):
+        # Las estrategias de subida se eligen según el agent: se recibe aquí y no se cambia después
+        self.agent = agent or DatacampusAgent()
+        self.use_cache = use_cache
+        # "libreoffice" o "reportlab" (ver CertificadosConfig.render_backend)
+        self.render_backend = render_backend or CertificadosConfig.render_backend
 
         # Carpeta en OneDrive donde viven los certificados por compañía.
         self.certificados_folder_id = os.getenv(
@@ -45,46 +70,91 @@ class CertificadosProcessor:
         if not self.excel_file_id and not self.excel_parent_folder_id:
             logger.warning("No se ha configurado EXCEL_FILE_ID ni EXCEL_PARENT_FOLDER_ID en .env")
 
+        # Empresas con más certificados que este umbral reciben un único ZIP (0 = siempre PDFs
+        # sueltos, por defecto). Cada ejecución sube su propio ZIP, sin pisar los anteriores
+        self.zip_min_certificados = int(os.getenv("ZIP_MIN_CERTIFICADOS", "0"))
+        self._id_ejecucion = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # Carpetas de empresa ya resueltas: nombre normalizado -> folder_id. Con caché
+        # arranca con las de ejecuciones anteriores (y cuándo se resolvieron)
+        self._carpetas_resueltas_en: Dict[str, float] = {}
+        self._carpetas_empresa: Dict[str, str] = self._load_folder_cache() if use_cache else {}
+        # Las compañías se suben desde varios hilos: dos con el mismo nombre normalizado
+        # no deben crear la carpeta dos veces
+        self._lock_carpetas = threading.Lock()
+        # Parser del JSON del Excel, elegido según la forma de la primera respuesta
+        self._parser_payload: Optional[Callable[[Dict[str, Any]], pd.DataFrame]] = None
+        # Cadenas de fallback de subida según lo que implemente el agent, resueltas una sola vez
+        self._subidores_pdf = self._resolver_subidores()
+        self._subidores_excel = self._resolver_subidores_excel()
+
     # API público
     def ejecutar_flujo_completo(self) -> bool:
         logger.info("=== INICIANDO FLUJO DE CERTIFICADOS ===")
-        try:
-            # 1) Autenticación
-            if not self._autenticar():
-                return False
-
-            # 2) Traer Excel desde OneDrive
-            excel_dict = self._obtener_excel_como_dict()
-            if not excel_dict:
-                return False
-
-            # 3) Generar certificados en memoria + DF actualizado
-            certificados_por_compania, df_actualizado = self._generar(cert_input=excel_dict)
-
-            # Si no hay nada para generar, igual actualizo Excel
-            if not certificados_por_compania:
-                logger.info("No hay registros pendientes de certificar")
-                # si el DF viene igual, no pasa nada
-                self._subir_excel_actualizado(df_actualizado)
-                logger.info("=== FLUJO COMPLETADO (sin pendientes) ===")
+        self._id_ejecucion = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Las conexiones keep-alive del agent se comparten en todo el flujo y se cierran al final
+        with self.agent:
+            try:
+                # 1) Autenticación
+                if not self._autenticar():
+                    return False
+
+                # 2) Traer Excel desde OneDrive
+                excel_dict = self._obtener_excel_como_dict()
+                if excel_dict is None:
+                    return False
+
+                # Las compañías con filas pendientes se conocen antes de generar: sus carpetas
+                # se resuelven todas juntas ($batch) y luego cada compañía solo sube
+                self._preparar_carpetas(excel_dict)
+
+                # 3) Generar certificados en memoria + DF actualizado, y
+                # 4) subir los PDFs de cada compañía en cuanto terminan de generarse,
+                #    mientras el resto sigue renderizándose
+                subidas = []
+                with ThreadPoolExecutor(max_workers=EMPRESAS_EN_PARALELO) as executor:
+                    certificados_por_compania, df_actualizado = self._generar(
+                        cert_input=excel_dict,
+                        al_completar_compania=lambda empresa, archivos: subidas.append(
+                            executor.submit(self._subir_certificados_por_empresa, {empresa: archivos})
+                        )
+                    )
+
+                # Las filas que no se pudieron generar siguen pendientes: se marca el resto,
+                # pero el flujo no se da por bueno
+                sin_generar = int(filas_pendientes(df_actualizado).sum())
+                if sin_generar:
+                    logger.error(f" {sin_generar} certificados no se pudieron generar; sus filas quedan pendientes")
+
+                # Sin certificados generados ninguna fila cambió: no se vuelve a subir el Excel
+                if not certificados_por_compania:
+                    logger.info("No hay registros pendientes de certificar")
+                    logger.info("=== FLUJO COMPLETADO (sin pendientes) ===")
+                    return True
+
+                # Las filas cuyo certificado no llegó a OneDrive tampoco se marcan
+                filas_sin_subir = [fila for subida in subidas for fila in subida.result()]
+                if filas_sin_subir:
+                    logger.error(f" {len(filas_sin_subir)} certificados no se pudieron subir; sus filas quedan pendientes")
+                    self._desmarcar_filas(df_actualizado, filas_sin_subir)
+                if self.use_cache:
+                    self._store_folder_cache()
+
+                # 5) Subir Excel actualizado a OneDrive (reemplazo)
+                if not self._subir_excel_actualizado(df_actualizado):
+                    return False
+                if sin_generar or filas_sin_subir:
+                    logger.error("=== FLUJO COMPLETADO CON ERRORES ===")
+                    return False
+
+                logger.info("=== FLUJO COMPLETADO EXITOSAMENTE ===")
                 return True
 
-            # 4) Subir PDFs por compañía a OneDrive
-            if not self._subir_certificados_por_empresa(certificados_por_compania):
-                return False
-
-            # 5) Subir Excel actualizado a OneDrive (reemplazo)
-            if not self._subir_excel_actualizado(df_actualizado):
+            except Exception as e:
+                logger.error(f"Error en el flujo principal: {str(e)}")
+                logger.error(traceback.format_exc())
                 return False
 
-            logger.info("=== FLUJO COMPLETADO EXITOSAMENTE ===")
-            return True
-
-        except Exception as e:
-            logger.error(f"Error en el flujo principal: {str(e)}")
-            logger.error(traceback.format_exc())
-            return False
-
     # Pasos internos
     def _autenticar(self) -> bool:
         logger.info("1) Autenticando con Microsoft Graph...")
@@ -98,10 +168,11 @@ class CertificadosProcessor:
             logger.error(f" Error durante autenticación: {str(e)}")
             return False
 
-    def _obtener_excel_como_dict(self) -> Optional[Dict[str, Any]]:
+    def _obtener_excel_como_dict(self) -> Optional[Union[Dict[str, Any], pd.DataFrame]]:
         """
         Se descarga el Excel desde OneDrive vía API y se convierte a un formato
-        amigable para generar_certificados_desde_excel:
+        amigable para generar_certificados_desde_excel. Si el agent puede leerlo
+        directamente de Graph se devuelve el DataFrame sin pasar por JSON.
         """
         logger.info("2) Descargando Excel desde OneDrive...")
         try:
@@ -109,19 +180,27 @@ class CertificadosProcessor:
                 logger.error(" EXCEL_FILE_ID no está configurado en .env")
                 return None
 
+            # Camino rápido: descarga en streaming + lectura directa con pandas
+            if getattr(self.agent, 'token', None) and hasattr(self.agent, 'obtener_excel_como_dataframe'):
+                etag = self.agent.obtener_etag(self.excel_file_id) if self.use_cache else None
+                df = self._load_cached_excel(self.excel_file_id, etag) if etag else None
+                if df is None:
+                    df = self.agent.obtener_excel_como_dataframe(self.excel_file_id)
+                    if df is not None and etag:
+                        self._store_cached_excel(self.excel_file_id, etag, df)
+                if df is not None:
+                    for col in ("nombre", "cedula", "compañia", "certificado"):
+                        if col not in df.columns:
+                            df[col] = ""
+                    logger.info(f" Excel leído con {len(df)} filas")
+                    return df
+
             # El agent debe devolverme un JSON. Yo lo normalizo a DataFrame.
             excel_payload = self.agent.obtener_excel_como_json(self.excel_file_id)
-            df: pd.DataFrame
-            if isinstance(excel_payload, dict) and 'data' in excel_payload and isinstance(excel_payload['data'], list):
-                # Caso 1: lista de dicts
-                if excel_payload.get('columns') is None or isinstance(excel_payload['data'][0], dict):
-                    df = pd.DataFrame(excel_payload['data'])
-                else:
-                    # Caso 2: columnas + data tabular
-                    df = pd.DataFrame(excel_payload['data'], columns=excel_payload['columns'])
-            else:
+            if not (isinstance(excel_payload, dict) and isinstance(excel_payload.get('data'), list)):
                 logger.error(" Respuesta del Excel no tiene el formato esperado")
                 return None
+            df = self._parsear_payload(excel_payload)
 
             for col in ("nombre", "cedula", "compañia", "certificado"):
                 if col not in df.columns:
@@ -129,22 +208,109 @@ class CertificadosProcessor:
 
             logger.info(f" Excel leído con {len(df)} filas")
 
-
-            columns = df.columns.tolist()
-            data = df.fillna("").astype(str).values.tolist()
-            return {"columns": columns, "data": data}
+            # generar_certificados_desde_excel acepta el DataFrame: no se pasa a listas
+            # por fila para que luego vuelva a armarse un DataFrame con ellas
+            return df.fillna("").astype(str)
 
         except Exception as e:
             logger.error(f" Error al obtener Excel: {str(e)}")
             return None
 
-    def _generar(self, cert_input: Dict[str, Any]) -> Tuple[Dict[str, List[Dict[str, Any]]], pd.DataFrame]:
+    def _parsear_payload(self, excel_payload: Dict[str, Any]) -> pd.DataFrame:
+        # La forma del payload es fija para un mismo agent: se detecta en la primera
+        # lectura y las siguientes van directo al parser elegido
+        if self._parser_payload is None:
+            filas = excel_payload['data']
+            if excel_payload.get('columns') is None or (filas and isinstance(filas[0], dict)):
+                # Caso 1: lista de dicts
+                self._parser_payload = self._payload_registros
+            else:
+                # Caso 2: columnas + data tabular
+                self._parser_payload = self._payload_tabular
+        return self._parser_payload(excel_payload)
+
+    @staticmethod
+    def _payload_registros(excel_payload: Dict[str, Any]) -> pd.DataFrame:
+        return pd.DataFrame(excel_payload['data'])
+
+    @staticmethod
+    def _payload_tabular(excel_payload: Dict[str, Any]) -> pd.DataFrame:
+        return pd.DataFrame(excel_payload['data'], columns=excel_payload['columns'])
+
+    @staticmethod
+    def _cache_prefix(file_id: str) -> str:
+        return hashlib.sha1(file_id.encode("utf-8")).hexdigest()
+
+    def _cache_path(self, file_id: str, etag: str) -> Path:
+        # <archivo>-<eTag>: las entradas de un mismo archivo comparten prefijo
+        etag_key = hashlib.sha1(etag.encode("utf-8")).hexdigest()
+        return EXCEL_CACHE_DIR / f"{self._cache_prefix(file_id)}-{etag_key}.parquet"
+
+    def _load_cached_excel(self, file_id: str, etag: str) -> Optional[pd.DataFrame]:
+        path = self._cache_path(file_id, etag)
+        if not path.exists():
+            return None
+        try:
+            df = pd.read_parquet(path)
+            logger.info(" Excel sin cambios: usando copia en caché")
+            return df
+        except Exception as e:
+            logger.warning(f" No se pudo leer la caché del Excel: {str(e)}")
+            return None
+
+    def _store_cached_excel(self, file_id: str, etag: str, df: pd.DataFrame) -> None:
+        try:
+            EXCEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            # Las entradas de otros eTag del mismo archivo ya no sirven; las de otros archivos sí
+            path = self._cache_path(file_id, etag)
+            for old in EXCEL_CACHE_DIR.glob(f"{self._cache_prefix(file_id)}-*.parquet"):
+                if old != path:
+                    old.unlink()
+            df.to_parquet(path, index=False)
+        except Exception as e:
+            # Sin pyarrow o sin permisos de escritura el flujo sigue, solo sin caché
+            logger.warning(f" No se pudo guardar la caché del Excel: {str(e)}")
+
+    def _load_folder_cache(self) -> Dict[str, str]:
+        try:
+            with open(FOLDER_CACHE_PATH, encoding="utf-8") as f:
+                guardadas = json.load(f).get(self.certificados_folder_id, {})
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f" No se pudo leer la caché de carpetas: {str(e)}")
+            return {}
+
+        limite = time.time() - FOLDER_CACHE_TTL
+        vigentes = {nombre: entrada for nombre, entrada in guardadas.items() if entrada[1] >= limite}
+        self._carpetas_resueltas_en = {nombre: resuelta_en for nombre, (_, resuelta_en) in vigentes.items()}
+        return {nombre: folder_id for nombre, (folder_id, _) in vigentes.items()}
+
+    def _store_folder_cache(self) -> None:
+        try:
+            guardadas = {}
+            if FOLDER_CACHE_PATH.exists():
+                with open(FOLDER_CACHE_PATH, encoding="utf-8") as f:
+                    guardadas = json.load(f)
+            ahora = time.time()
+            guardadas[self.certificados_folder_id] = {
+                nombre: [folder_id, self._carpetas_resueltas_en.get(nombre, ahora)]
+                for nombre, folder_id in self._carpetas_empresa.items() if folder_id
+            }
+            FOLDER_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            with open(FOLDER_CACHE_PATH, "w", encoding="utf-8") as f:
+                json.dump(guardadas, f, ensure_ascii=False)
+        except Exception as e:
+            logger.warning(f" No se pudo guardar la caché de carpetas: {str(e)}")
+
+    def _generar(self, cert_input: Union[Dict[str, Any], pd.DataFrame],
+                 al_completar_compania: Optional[Callable[[str, List[Dict[str, Any]]], None]] = None
+                 ) -> Tuple[Dict[str, List[Dict[str, Any]]], pd.DataFrame]:
 
         logger.info("3) Generando certificados PDF en memoria...")
-        import asyncio
         try:
             certificados_por_compania, df_actualizado = asyncio.run(
-                generar_certificados_desde_excel(cert_input)
+                generar_certificados_desde_excel(cert_input, al_completar_compania, self.render_backend)
             )
             total = sum(len(v) for v in certificados_por_compania.values())
             logger.info(f" Generados {total} certificados en memoria")
@@ -153,81 +319,229 @@ class CertificadosProcessor:
             logger.error(f" Error al generar certificados: {str(e)}")
             raise
 
-    def _subir_certificados_por_empresa(self, certificados: Dict[str, List[Dict[str, Any]]]) -> bool:
+    def _subir_certificados_por_empresa(self, certificados: Dict[str, List[Dict[str, Any]]]) -> List[Any]:
+        """
+        Sube los certificados de cada empresa a su carpeta.
 
-        logger.info("4) Subiendo certificados por empresa a OneDrive...")
+        Devuelve las filas del Excel cuyo certificado no quedó en OneDrive (vacío si se
+        subió todo): el flujo las deja pendientes para la próxima ejecución.
+        """
+        logger.info(f"4) Subiendo certificados de {', '.join(certificados)} a OneDrive...")
+        filas_sin_subir = []
         try:
+            # Nombre de carpeta normalizado una sola vez por empresa
+            nombres_carpeta = {empresa: self._normalizar_nombre_carpeta(empresa) for empresa in certificados}
+
+            # Normalmente ya resueltas por _preparar_carpetas: aquí solo se consultan las que falten
+            self._resolver_carpetas(nombres_carpeta.values())
+            carpetas_empresa = self._carpetas_empresa
+
+            pendientes = []
             for empresa, archivos in certificados.items():
-                empresa_norm = self._normalizar_nombre_carpeta(empresa)
+                empresa_norm = nombres_carpeta[empresa]
                 logger.info(f"  Procesando empresa: {empresa_norm}")
 
-                folder_empresa_id = self._crear_carpeta_empresa(empresa_norm)
+                folder_empresa_id = carpetas_empresa.get(empresa_norm)
                 if not folder_empresa_id:
                     # Si no pude crear/ubicar la carpeta, sigo con las demás
+                    filas_sin_subir.extend(item["fila"] for item in archivos)
                     continue
 
+                # Filas repetidas (misma persona dos veces) dan el mismo nombre de archivo en
+                # la misma carpeta: se sube solo el último, que es el que quedaría en OneDrive.
+                # Comparar por hash no sirve: cada exportación a PDF lleva su fecha e ID propios
+                filas_por_archivo = {}
                 for item in archivos:
-                    filename: str = item["filename"]
-                    content: bytes = item["content"]
+                    filas_por_archivo.setdefault(item["filename"], []).append(item["fila"])
+                archivos = list({item["filename"]: item for item in archivos}.values())
+
+                if self.zip_min_certificados and len(archivos) > self.zip_min_certificados:
+                    # Un archivo de ~MB en vez de N PDFs pequeños: en OneDrive el coste por
+                    # archivo domina (~16 KiB/s con archivos de 4 KiB frente a ~1.6 MiB/s con
+                    # archivos de 1 MiB), así que no volver a subir PDF por PDF en lotes grandes
+                    pendientes.append((
+                        empresa_norm, folder_empresa_id,
+                        f"{empresa_norm}_certificados_{self._id_ejecucion}.zip", self._comprimir_certificados(archivos),
+                        [fila for filas in filas_por_archivo.values() for fila in filas]
+                    ))
+                    continue
 
-                    # Se arma un stream en memoria. Algunos endpoints requieren .name
-                    bio = io.BytesIO(content)
-                    setattr(bio, 'name', filename)
+                for item in archivos:
+                    pendientes.append((
+                        empresa_norm, folder_empresa_id, item["filename"], item["content"],
+                        filas_por_archivo[item["filename"]]
+                    ))
+
+            fallidos = self._subir_pendientes(pendientes)
+
+            # Con alguna subida fallida el ID de la carpeta (quizá de la caché) puede estar
+            # obsoleto: se vuelve a consultar en Graph y, si cambió, se reintenta en esta ejecución
+            if fallidos:
+                ids_anteriores = {pendiente[0]: pendiente[1] for pendiente in fallidos}
+                with self._lock_carpetas:
+                    for empresa_norm, folder_id in ids_anteriores.items():
+                        if carpetas_empresa.get(empresa_norm) == folder_id:
+                            carpetas_empresa.pop(empresa_norm, None)
+                            self._carpetas_resueltas_en.pop(empresa_norm, None)
+                self._resolver_carpetas(ids_anteriores)
+
+                reintentos, sin_subir = [], []
+                for empresa_norm, folder_id, filename, content, filas in fallidos:
+                    nuevo_id = carpetas_empresa.get(empresa_norm)
+                    if nuevo_id and nuevo_id != folder_id:
+                        logger.info(f"     Carpeta {empresa_norm} actualizada, reintentando {filename}")
+                        reintentos.append((empresa_norm, nuevo_id, filename, content, filas))
+                    else:
+                        sin_subir.append((empresa_norm, folder_id, filename, content, filas))
+                sin_subir.extend(self._subir_pendientes(reintentos))
 
-                    ok = False
+                # Si ni así se pudo, la próxima ejecución vuelve a consultarlas en Graph
+                with self._lock_carpetas:
+                    for empresa_norm, _, _, _, filas in sin_subir:
+                        carpetas_empresa.pop(empresa_norm, None)
+                        filas_sin_subir.extend(filas)
 
-                    if hasattr(self.agent, 'subir_pdf'):
-                        try:
-                            ok = self.agent.subir_pdf(bio, folder_id=folder_empresa_id, filename=filename)
-                        except TypeError:
-                            
-                            ok = False
+            return filas_sin_subir
+        except Exception as e:
+            logger.error(f" Error al subir certificados: {str(e)}")
+            return [item["fila"] for archivos in certificados.values() for item in archivos]
+
+    def _subir_pendientes(self, pendientes: List[Tuple[str, str, str, bytes, List[Any]]]
+                          ) -> List[Tuple[str, str, str, bytes, List[Any]]]:
+        """Sube (empresa, carpeta, archivo, contenido, filas) en paralelo y devuelve los que fallaron"""
+        fallidos = []
+        if not pendientes:
+            return fallidos
+
+        # Subida en paralelo de todos los PDFs cuando el agent lo soporta
+        if hasattr(self.agent, 'subir_pdfs_bulk'):
+            resultados = self.agent.subir_pdfs_bulk(
+                [(folder_id, filename, content) for _, folder_id, filename, content, _ in pendientes]
+            )
+            for pendiente, ok in zip(pendientes, resultados):
+                self._log_subida(pendiente[2], ok)
+                if not ok:
+                    fallidos.append(pendiente)
+            return fallidos
+
+        # Cadena de fallbacks por archivo, en paralelo y registrando según terminan
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_CONCURRENCY, len(pendientes))) as executor:
+            futures = {executor.submit(self._subir_pdf, *pendiente[:4]): pendiente for pendiente in pendientes}
+            for future in as_completed(futures):
+                pendiente = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    logger.error(f"     Excepción subiendo {pendiente[2]}: {str(e)}")
+                    ok = False
+                self._log_subida(pendiente[2], ok)
+                if not ok:
+                    fallidos.append(pendiente)
+        return fallidos
 
-                    if not ok and hasattr(self.agent, 'subir_pdf_bytes'):
-                        ok = self.agent.subir_pdf_bytes(content, folder_id=folder_empresa_id, filename=filename)
+    @staticmethod
+    def _desmarcar_filas(df: pd.DataFrame, filas: List[Any]) -> None:
+        if isinstance(df["certificado"].dtype, pd.CategoricalDtype) and "no" not in df["certificado"].cat.categories:
+            df["certificado"] = df["certificado"].cat.add_categories(["no"])
+        df.loc[filas, "certificado"] = "no"
+
+    def _preparar_carpetas(self, df: pd.DataFrame) -> None:
+        """Resuelve de una vez las carpetas de todas las compañías con certificados pendientes"""
+        empresas = df.loc[filas_pendientes(df), "compañia"].unique()
+        if len(empresas):
+            logger.info(f"  Preparando carpetas de {len(empresas)} empresas...")
+            self._resolver_carpetas(self._normalizar_nombre_carpeta(str(empresa)) for empresa in empresas)
+
+    def _resolver_carpetas(self, nombres: Iterable[str]) -> None:
+        nombres = list(dict.fromkeys(nombres))
+        carpetas_empresa = self._carpetas_empresa
+        with self._lock_carpetas:
+            # Resolver con $batch las carpetas que aún no se conocen
+            por_resolver = [nombre for nombre in nombres if nombre not in carpetas_empresa]
+            if por_resolver and hasattr(self.agent, 'crear_carpetas_bulk'):
+                carpetas_empresa.update(self.agent.crear_carpetas_bulk(
+                    por_resolver,
+                    parent_id=self.certificados_folder_id
+                ))
+
+            # Las que el lote no resolvió se crean todas a la vez, no una por empresa en el bucle
+            faltantes = [nombre for nombre in nombres if not carpetas_empresa.get(nombre)]
+            if faltantes:
+                with ThreadPoolExecutor(max_workers=min(8, len(faltantes))) as executor:
+                    list(executor.map(self._crear_carpeta_empresa, faltantes))
 
-                    if not ok and hasattr(self.agent, 'upload_file'):
-                        # Plan C: API genérica
-                        ok = self.agent.upload_file(content, path=f"/certificados/{empresa_norm}/{filename}")
+    @staticmethod
+    def _log_subida(filename: str, ok: bool) -> None:
+        if ok:
+            logger.info(f"     Subido: {filename}")
+        else:
+            logger.warning(f"     Error subiendo: {filename}")
 
-                    if ok:
-                        logger.info(f"     Subido: {filename}")
-                    else:
-                        logger.warning(f"     Error subiendo: {filename}")
+    @staticmethod
+    def _comprimir_certificados(archivos: List[Dict[str, Any]]) -> bytes:
+        # ZIP_STORED: los PDFs ya vienen comprimidos, recomprimir solo gasta CPU
+        with io.BytesIO() as buffer:
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zf:
+                for item in archivos:
+                    zf.writestr(item["filename"], item["content"])
+            return buffer.getvalue()
+
+    def _resolver_subidores(self) -> List[Callable[[str, str, str, bytes], bool]]:
+        # La cadena de fallbacks se resuelve al crear el processor, no con hasattr por cada archivo.
+        # Los bytes se suben tal cual; solo se envuelven en un stream si el agent lo exige
+        subidores = []
+        if hasattr(self.agent, 'subir_pdf_bytes'):
+            subidores.append(self._subir_pdf_bytes)
+        if hasattr(self.agent, 'subir_pdf'):
+            subidores.append(self._subir_pdf_stream)
+        if hasattr(self.agent, 'upload_file'):
+            # Plan C: API genérica
+            subidores.append(self._subir_pdf_generico)
+        return subidores
+
+    def _subir_pdf(self, empresa_norm: str, folder_empresa_id: str, filename: str, content: bytes) -> bool:
+        for subidor in self._subidores_pdf:
+            if subidor(empresa_norm, folder_empresa_id, filename, content):
+                return True
+        return False
+
+    def _subir_pdf_bytes(self, empresa_norm: str, folder_empresa_id: str, filename: str, content: bytes) -> bool:
+        return self.agent.subir_pdf_bytes(content, folder_id=folder_empresa_id, filename=filename)
+
+    def _subir_pdf_stream(self, empresa_norm: str, folder_empresa_id: str, filename: str, content: bytes) -> bool:
+        # Se arma un stream en memoria (algunos endpoints requieren .name) y se
+        # libera al terminar la subida, sin esperar al GC con muchas subidas en vuelo
+        with io.BytesIO(content) as bio:
+            setattr(bio, 'name', filename)
+            try:
+                return self.agent.subir_pdf(bio, folder_id=folder_empresa_id, filename=filename)
+            except TypeError:
+                return False
 
-            return True
-        except Exception as e:
-            logger.error(f" Error al subir certificados: {str(e)}")
-            return False
+    def _subir_pdf_generico(self, empresa_norm: str, folder_empresa_id: str, filename: str, content: bytes) -> bool:
+        return self.agent.upload_file(content, path=f"/certificados/{empresa_norm}/{filename}")
 
     def _subir_excel_actualizado(self, df_actualizado: pd.DataFrame) -> bool:
 
         logger.info("5) Actualizando Excel en OneDrive...")
         try:
-            buffer = io.BytesIO()
-            df_actualizado.to_excel(buffer, index=False)
-            content = buffer.getvalue()
-
-            ok = False
-            if self.excel_file_id and hasattr(self.agent, 'actualizar_archivo_por_id'):
-                ok = self.agent.actualizar_archivo_por_id(self.excel_file_id, content)
-
-            if not ok and hasattr(self.agent, 'subir_pdf'):
-                bio = io.BytesIO(content)
-                setattr(bio, 'name', self.excel_file_name)
-                ok = self.agent.subir_pdf(bio, folder_id=self.excel_parent_folder_id, filename=self.excel_file_name)
-
-            if not ok and hasattr(self.agent, 'crear_reporte'):
-                # Último recurso: endpoint que construye Excel desde columnas/series
-                cols = df_actualizado.columns.tolist()
-                data = df_actualizado.fillna("").astype(str).values.tolist()
-                payload = {col: [row[i] for row in data] for i, col in enumerate(cols)}
-                ok = self.agent.crear_reporte(
-                    folder_id=self.excel_parent_folder_id,
-                    nombre_archivo=self.excel_file_name,
-                    datos=payload
-                )
+            if os.getenv("EXCEL_AS_PARQUET") == "1" and hasattr(self.agent, 'subir_dataframe_intermedio'):
+                # Copia adicional en parquet para quien consuma los datos por columnas. El .xlsx
+                # se actualiza igual: es el que se lee en la próxima ejecución para saber qué
+                # filas ya tienen certificado
+                nombre_parquet = f"{Path(self.excel_file_name).stem}.parquet"
+                if self.agent.subir_dataframe_intermedio(
+                    df_actualizado, folder_id=self.excel_parent_folder_id,
+                    nombre_archivo=nombre_parquet, formato="parquet"
+                ):
+                    logger.info(f" Datos actualizados guardados también como {nombre_parquet}")
+                else:
+                    logger.warning(f" No se pudo subir {nombre_parquet}")
+
+            # xlsxwriter en constant_memory, fila a fila, en vez de armar el libro con openpyxl
+            content = dataframe_a_xlsx(df_actualizado, sheet_name="Sheet1")
 
+            ok = any(subidor(df_actualizado, content) for subidor in self._subidores_excel)
             if ok:
                 logger.info(" Excel actualizado correctamente")
                 return True
@@ -238,8 +552,43 @@ class CertificadosProcessor:
             logger.error(f" Error al actualizar Excel: {str(e)}")
             return False
 
+    def _resolver_subidores_excel(self) -> List[Callable[[pd.DataFrame, bytes], bool]]:
+        # Mismo esquema que los PDFs: actualizar por id, subir a la carpeta y, como último
+        # recurso, el endpoint que construye el Excel desde columnas/series
+        subidores = []
+        if self.excel_file_id and hasattr(self.agent, 'actualizar_archivo_por_id'):
+            subidores.append(self._subir_excel_por_id)
+        if hasattr(self.agent, 'subir_pdf_bytes'):
+            subidores.append(self._subir_excel_bytes)
+        if hasattr(self.agent, 'subir_pdf'):
+            subidores.append(self._subir_excel_stream)
+        if hasattr(self.agent, 'crear_reporte'):
+            subidores.append(self._subir_excel_reporte)
+        return subidores
+
+    def _subir_excel_por_id(self, df: pd.DataFrame, content: bytes) -> bool:
+        return self.agent.actualizar_archivo_por_id(self.excel_file_id, content)
+
+    def _subir_excel_bytes(self, df: pd.DataFrame, content: bytes) -> bool:
+        return self.agent.subir_pdf_bytes(content, folder_id=self.excel_parent_folder_id, filename=self.excel_file_name)
+
+    def _subir_excel_stream(self, df: pd.DataFrame, content: bytes) -> bool:
+        with io.BytesIO(content) as bio:
+            setattr(bio, 'name', self.excel_file_name)
+            return self.agent.subir_pdf(bio, folder_id=self.excel_parent_folder_id, filename=self.excel_file_name)
+
+    def _subir_excel_reporte(self, df: pd.DataFrame, content: bytes) -> bool:
+        payload = df.fillna("").astype(str).to_dict(orient="list")
+        return self.agent.crear_reporte(
+            folder_id=self.excel_parent_folder_id,
+            nombre_archivo=self.excel_file_name,
+            datos=payload
+        )
+
     # Utilidades
     def _crear_carpeta_empresa(self, empresa: str) -> Optional[str]:
+        if empresa in self._carpetas_empresa:
+            return self._carpetas_empresa[empresa]
         try:
             folder_id = None
             if hasattr(self.agent, 'crear_carpeta'):
@@ -249,6 +598,7 @@ class CertificadosProcessor:
 
             if folder_id:
                 logger.info(f"     Carpeta creada/encontrada: {empresa}")
+                self._carpetas_empresa[empresa] = folder_id
                 return folder_id
 
             logger.warning(f"     No se pudo crear carpeta: {empresa}")
@@ -259,7 +609,7 @@ class CertificadosProcessor:
 
     @staticmethod
     def _normalizar_nombre_carpeta(nombre: str) -> str:
-        limpio = ''.join(c for c in nombre if c.isalnum() or c in (' ', '-', '_')).strip()
+        limpio = _NO_PERMITIDOS_CARPETA.sub('', nombre).strip()
         return limpio or 'Sin_Nombre'
 
 
@@ -0,0 +1,116 @@
+import io
+import threading
+
+import pandas as pd
+import pytest
+
+import core.certificados as certificados
+from tests.test_e2e import CertificadosProcessor
+
+DATOS_PERSONA = "samples/datos_persona.xlsx"
+
+
+class AgentFalso:
+    """Agent en memoria: registra carpetas, subidas y el Excel final"""
+
+    def __init__(self, df: pd.DataFrame, fallar=()):
+        self.token = "token"
+        self.df = df
+        self.fallar = set(fallar)
+        self.lotes_carpetas = []
+        self.subidos = []
+        self.excel = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def autenticar(self):
+        return True
+
+    def obtener_etag(self, file_id):
+        return None
+
+    def obtener_excel_como_dataframe(self, file_id):
+        return self.df.copy()
+
+    def crear_carpetas_bulk(self, names, parent_id=None):
+        with self._lock:
+            self.lotes_carpetas.append(list(names))
+        return {nombre: f"id-{nombre}" for nombre in names}
+
+    def subir_pdfs_bulk(self, items):
+        resultados = []
+        with self._lock:
+            for folder_id, filename, content in items:
+                ok = filename not in self.fallar
+                if ok:
+                    self.subidos.append((folder_id, filename))
+                resultados.append(ok)
+        return resultados
+
+    def actualizar_archivo_por_id(self, file_id, content):
+        self.excel = pd.read_excel(io.BytesIO(content), dtype=str, na_filter=False)
+        return True
+
+
+def _procesador(monkeypatch, agent):
+    monkeypatch.setenv("EXCEL_FILE_ID", "excel-id")
+    monkeypatch.delenv("ZIP_MIN_CERTIFICADOS", raising=False)
+    return CertificadosProcessor(use_cache=False, agent=agent)
+
+
+@pytest.fixture
+def datos():
+    return pd.read_excel(DATOS_PERSONA, dtype=str, na_filter=False)
+
+
+def test_flujo_sube_pendientes_y_marca_el_excel(monkeypatch, datos):
+    agent = AgentFalso(datos)
+
+    assert _procesador(monkeypatch, agent).ejecutar_flujo_completo()
+
+    pendientes = datos[datos["certificado"] == "no"]
+    # Todas las carpetas en un solo lote, antes de generar
+    assert len(agent.lotes_carpetas) == 1
+    assert sorted(agent.lotes_carpetas[0]) == sorted(pendientes["compañia"])
+    assert sorted(filename for _, filename in agent.subidos) == sorted(
+        "certificado_" + nombre.replace(" ", "_") + ".pdf" for nombre in pendientes["nombre"]
+    )
+    assert (agent.excel["certificado"] == "si").all()
+    assert list(agent.excel.columns) == list(datos.columns)
+
+
+def test_filas_repetidas_se_suben_una_vez(monkeypatch, datos):
+    repetida = datos[datos["certificado"] == "no"].iloc[[0]]
+    agent = AgentFalso(pd.concat([datos, repetida], ignore_index=True))
+
+    assert _procesador(monkeypatch, agent).ejecutar_flujo_completo()
+
+    filenames = [filename for _, filename in agent.subidos]
+    assert len(filenames) == len(set(filenames)) == 3
+    assert (agent.excel["certificado"] == "si").all()
+
+
+def test_subida_fallida_deja_la_fila_pendiente(monkeypatch, datos):
+    fila = datos.index[datos["certificado"] == "no"][0]
+    archivo = "certificado_" + datos.at[fila, "nombre"].replace(" ", "_") + ".pdf"
+    agent = AgentFalso(datos, fallar={archivo})
+
+    assert not _procesador(monkeypatch, agent).ejecutar_flujo_completo()
+
+    assert agent.excel.at[fila, "certificado"] == "no"
+    assert (agent.excel.drop(index=fila)["certificado"] == "si").all()
+
+
+def test_si_no_se_genera_ninguno_el_flujo_falla(monkeypatch, datos):
+    monkeypatch.setattr(certificados, "_plantilla_bytes", lambda path=None: b"no es un docx")
+    agent = AgentFalso(datos)
+
+    assert not _procesador(monkeypatch, agent).ejecutar_flujo_completo()
+
+    assert agent.subidos == []
+    assert agent.excel is None